@@ -1,7 +1,29 @@
-from datetime import date
+import time
+from datetime import date, datetime, timedelta
 from src.core.config import SETTINGS, ALLOWED_USERS, ALLOWED_GROUPS
 from src.core.database import USER_DAILY_USAGE, save_persistence
 
+# Today's date string, recomputed only when local midnight passes
+_TODAY_CACHE = {"s": "", "until": 0.0}
+
+def today_str() -> str:
+    """Cached str(date.today())"""
+    now = time.time()
+    if now >= _TODAY_CACHE["until"]:
+        today = date.today()
+        _TODAY_CACHE["s"] = str(today)
+        _TODAY_CACHE["until"] = datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+    return _TODAY_CACHE["s"]
+
+def _usage_entry(user_id: int) -> dict:
+    """Today's usage record for a user (reset in place on date rollover)"""
+    today = today_str()
+    entry = USER_DAILY_USAGE.setdefault(user_id, {"count": 0, "date": today})
+    if entry["date"] != today:
+        entry["count"] = 0
+        entry["date"] = today
+    return entry
+
 def get_user_limit(user_id: int) -> int:
     """Return daily request limit for a user."""
     # 1. Admin
@@ -52,23 +74,17 @@ def check_daily_limit(user_id: int) -> tuple[bool, int]:
         return True, 999
     
     # Get today's usage
-    today = str(date.today())
-    if user_id not in USER_DAILY_USAGE or USER_DAILY_USAGE[user_id]["date"] != today:
-        USER_DAILY_USAGE[user_id] = {"count": 0, "date": today}
-    
-    current_count = USER_DAILY_USAGE[user_id]["count"]
+    current_count = _usage_entry(user_id)["count"]
     remaining = user_limit - current_count
     
     return remaining > 0, remaining
 
 def increment_daily_usage(user_id: int) -> int:
     """Increment user's daily usage count. Returns remaining requests."""
-    today = str(date.today())
-    if user_id not in USER_DAILY_USAGE or USER_DAILY_USAGE[user_id]["date"] != today:
-        USER_DAILY_USAGE[user_id] = {"count": 0, "date": today}
-    USER_DAILY_USAGE[user_id]["count"] += 1
+    entry = _usage_entry(user_id)
+    entry["count"] += 1
     save_persistence()
     
     # Return remaining
     user_limit = get_user_limit(user_id)
-    return user_limit - USER_DAILY_USAGE[user_id]["count"]
+    return user_limit - entry["count"]
@@ -14,16 +14,19 @@ class ColoredFormatter(logging.Formatter):
         'RESET': '\033[0m'      # Reset
     }
     
+    def __init__(self):
+        # Shorten format for cleaner output (parsed once, not per record)
+        super().__init__("%(levelname)s - %(name)s - %(message)s")
+
     def format(self, record):
-        # Add color to level name
+        # Add color to level name (restored afterwards so other handlers see it plain)
         levelname = record.levelname
         if levelname in self.COLORS:
             record.levelname = f"{self.COLORS[levelname]}{levelname}{self.COLORS['RESET']}"
-        
-        # Shorten format for cleaner output
-        log_fmt = "%(levelname)s - %(name)s - %(message)s"
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        try:
+            return super().format(record)
+        finally:
+            record.levelname = levelname
 
 def setup_logger(name="SushiYar", level=logging.INFO):
     """Configure and return a logger instance."""
@@ -8,6 +8,12 @@ import logging
 from typing import Optional
 import subprocess
 import signal
+import tempfile
+import functools
+import hashlib
+import sqlite3
+import threading
+from types import MappingProxyType
 import warnings
 # Suppress Pydantic V1 warning on Python 3.14+
 warnings.filterwarnings("ignore", category=UserWarning, module="langchain_core._api.deprecation")
@@ -16,14 +22,14 @@ from pathlib import Path
 from dotenv import load_dotenv
 import argparse
 import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
-import uuid
 import urllib.parse
-import urllib.request
 import edge_tts
+import aiofiles
 import html
 import httpx
-from bs4 import BeautifulSoup
 import time
 import wave
 import struct
@@ -36,15 +42,24 @@ np = None
 # Optional: Sherpa-ONNX removed
 SHERPA_AVAILABLE = False
 
+# Optional: orjson (faster JSON); falls back to the stdlib json module
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
 # Telegram Imports
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, constants
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, constants
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 
 # LangChain Imports
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+# Provider SDKs (langchain_google_genai / langchain_openai) are imported lazily
+# where the models are built, so startup doesn't pay for them.
+from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.callbacks import AsyncCallbackHandler
 
 # ==============================================================================
@@ -65,16 +80,19 @@ class ColoredFormatter(logging.Formatter):
         'RESET': '\033[0m'      # Reset
     }
     
+    def __init__(self):
+        # Shorten format for cleaner output (parsed once, not per record)
+        super().__init__("%(levelname)s - %(name)s - %(message)s")
+
     def format(self, record):
-        # Add color to level name
+        # Add color to level name (restored afterwards so other handlers see it plain)
         levelname = record.levelname
         if levelname in self.COLORS:
             record.levelname = f"{self.COLORS[levelname]}{levelname}{self.COLORS['RESET']}"
-        
-        # Shorten format for cleaner output
-        log_fmt = "%(levelname)s - %(name)s - %(message)s"
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        try:
+            return super().format(record)
+        finally:
+            record.levelname = levelname
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -134,12 +152,202 @@ ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY", "").strip()
 
 from src.core.config import SETTINGS, STORAGE_DIR, LOGS_DIR, TEMP_DIR
 
+# Never changed at runtime (no command sets them): read once
+MIN_FC_LEN = SETTINGS["min_fc_len"]
+ADMIN_ID = SETTINGS["admin_id"]
+
 def get_storage_path(filename: str) -> str:
     """Resolve storage path relative to ~/.su6i-yar/storage/"""
     return os.path.join(STORAGE_DIR, filename)
 
-# Rate Limiting (per user)
-RATE_LIMIT = {}  # user_id -> last_request_time
+class LRUDict(OrderedDict):
+    """Dict bounded to `maxsize` entries; the least recently used key is evicted first"""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+# Transient per-user state (rate limiting + cached /detail analysis) in one record
+class UserState:
+    __slots__ = ("last_req_ts", "last_analysis", "analysis_ts")
+
+    def __init__(self):
+        self.last_req_ts = 0.0
+        self.last_analysis = None
+        self.analysis_ts = 0.0
+
+USER_STATE: dict[int, UserState] = LRUDict(maxsize=10_000)  # user_id -> UserState (bounded)
+ANALYSIS_TTL_SECONDS = 86400  # cached /detail analyses expire after a day
+ANALYSIS_CACHE_MAX = 1024  # analyses are multi-KB: keep only the most recent ones
+_ANALYSIS_HOLDERS: OrderedDict[int, None] = OrderedDict()  # user_ids holding an analysis, LRU order
+
+def user_state(user_id) -> UserState:
+    """Get (or create) the transient state record for a user"""
+    state = USER_STATE.get(user_id)
+    if state is None:
+        state = USER_STATE[user_id] = UserState()
+    return state
+
+def get_last_analysis(user_id, default=None):
+    """Cached detailed analysis for /detail and /voice (no record is created)"""
+    state = USER_STATE.get(user_id)
+    if state is None or state.last_analysis is None:
+        return default
+    if time.monotonic() - state.analysis_ts > ANALYSIS_TTL_SECONDS:
+        state.last_analysis = None  # expired: release the text
+        return default
+    return state.last_analysis
+
+def set_last_analysis(user_id, text):
+    """Cache the detailed analysis for /detail and /voice"""
+    state = user_state(user_id)
+    state.last_analysis = text
+    state.analysis_ts = time.monotonic()
+    _ANALYSIS_HOLDERS[user_id] = None
+    _ANALYSIS_HOLDERS.move_to_end(user_id)
+    while len(_ANALYSIS_HOLDERS) > ANALYSIS_CACHE_MAX:
+        old_uid, _ = _ANALYSIS_HOLDERS.popitem(last=False)
+        # dict.get: peek without refreshing the user's LRU position
+        old_state = dict.get(USER_STATE, old_uid)
+        if old_state is not None:
+            old_state.last_analysis = None
+
+# ==============================================================================
+# CONCURRENCY: bounded downloads/AI calls + per-chat FIFO
+# ==============================================================================
+DL_SEM = asyncio.Semaphore(4)   # concurrent yt-dlp downloads
+AI_SEM = asyncio.Semaphore(8)   # concurrent fact-check LLM calls
+CHAT_QUEUES: dict[int, asyncio.Queue] = {}  # chat_id -> pending (coro, update, context)
+CHAT_WORKERS: set[asyncio.Task] = set()     # strong refs to the running per-chat workers
+CHAT_QUEUE_IDLE_SECONDS = 60
+IO_EXECUTOR_WORKERS = 32  # default executor size; work offloaded there is I/O-bound
+
+def enqueue_chat_work(chat_id, coro, update=None, context=None):
+    """Run `coro` after earlier work from the same chat; other chats run concurrently.
+    Failures are reported like handler errors when `update`/`context` are given."""
+    queue = CHAT_QUEUES.get(chat_id)
+    if queue is None:
+        queue = CHAT_QUEUES[chat_id] = asyncio.Queue()
+        worker = asyncio.create_task(_drain_chat_queue(chat_id, queue))
+        CHAT_WORKERS.add(worker)
+        worker.add_done_callback(CHAT_WORKERS.discard)
+    queue.put_nowait((coro, update, context))
+
+async def _report_queued_failure(chat_id, error, update, context):
+    """Route a queued task's exception through PTB's error handlers (admin report) and tell the user"""
+    if context is None:
+        logger.error(f"❌ [Chat {chat_id}] Queued task failed: {error}", exc_info=error)
+        return
+    try:
+        await context.application.process_error(update, error)
+    except Exception as e:
+        logger.error(f"❌ [Chat {chat_id}] Error handler failed: {e}")
+    msg = getattr(update, "effective_message", None)
+    if msg is not None:
+        try:
+            await msg.reply_text(get_msg("task_error", update.effective_user.id))
+        except Exception as e:
+            logger.error(f"Failed to send error reply: {e}")
+
+async def _drain_chat_queue(chat_id, queue):
+    """Per-chat worker: executes queued work in order, exits when idle"""
+    while True:
+        try:
+            coro, update, context = await asyncio.wait_for(queue.get(), timeout=CHAT_QUEUE_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            if queue.empty():
+                CHAT_QUEUES.pop(chat_id, None)
+                return
+            continue
+        try:
+            await coro
+        except Exception as e:
+            await _report_queued_failure(chat_id, e, update, context)
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()  # FIFO order for waiters
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Telegram allows ~30 msg/s per bot; stay under it instead of eating 429 retries
+TG_SEND_BUCKET = TokenBucket(rate=25, capacity=25)
+# ...and ~20 msg/min per group: one bucket per group/supergroup chat
+TG_GROUP_RATE_PER_MIN = 18
+TG_GROUP_BUCKETS: dict[int, TokenBucket] = LRUDict(maxsize=1000)
+_GROUP_CHAT_TYPES = frozenset({constants.ChatType.GROUP, constants.ChatType.SUPERGROUP})
+
+def _group_bucket(send, chat_type, kwargs) -> Optional[TokenBucket]:
+    """Per-group bucket for a new message in a group/supergroup (edits and channels
+    are exempt). The chat type comes from the bound Message, or from the caller's
+    chat_type= for bot.send_* calls."""
+    if getattr(send, "__name__", "").startswith("edit"):
+        return None
+    owner = getattr(send, "__self__", None)
+    if chat_type is None:
+        chat_type = getattr(getattr(owner, "chat", None), "type", None)
+    if chat_type not in _GROUP_CHAT_TYPES:
+        return None
+    chat_id = kwargs.get("chat_id", getattr(owner, "chat_id", None))
+    if chat_id is None:
+        return None
+    bucket = TG_GROUP_BUCKETS.get(chat_id)
+    if bucket is None:
+        bucket = TG_GROUP_BUCKETS[chat_id] = TokenBucket(
+            rate=TG_GROUP_RATE_PER_MIN / 60, capacity=TG_GROUP_RATE_PER_MIN
+        )
+    return bucket
+
+TG_SEND_MAX_RETRIES = 2
+
+async def tg_send(send, *args, **kwargs):
+    """Call a Telegram send/edit method (e.g. msg.reply_text) through the global token bucket
+    (plus the group's bucket in groups). A 429 (RetryAfter) is waited out and retried
+    instead of failing the send. Pass chat_type= when `send` isn't bound to a Message."""
+    group_bucket = _group_bucket(send, kwargs.pop("chat_type", None), kwargs)
+    for attempt in range(TG_SEND_MAX_RETRIES + 1):
+        if group_bucket is not None:
+            await group_bucket.acquire()
+        await TG_SEND_BUCKET.acquire()
+        try:
+            return await send(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == TG_SEND_MAX_RETRIES:
+                raise
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.warning(f"⏳ Telegram flood control: retrying in {delay}s")
+            await asyncio.sleep(delay)
 
 # Market Data Caching (tgju.org)
 MARKET_DATA_CACHE = None
@@ -157,7 +365,7 @@ ALLOWED_USERS = {
 ALLOWED_GROUPS = set()  # Add group IDs here, e.g., {-1001234567890}
 
 # Daily request tracking
-from datetime import date
+from datetime import date, datetime, timedelta
 USER_DAILY_USAGE = {}  # user_id -> {"count": int, "date": str}
 USER_LANG = {}         # user_id -> "fa" | "en" | "fr" | "ko"
 SEARCH_FILE_ID = None  # Persistent telegram file_id for the status GIF
@@ -166,19 +374,94 @@ BIRTHDAYS = {}         # user_id -> {"month": int, "day": int, "year": int, "use
 PERSISTENCE_FILE = get_storage_path("user_data.json")
 BIRTHDAY_FILE = get_storage_path("birthdays.json")
 
-def save_persistence():
-    """Save user languages and daily usage to file."""
+# Today's date string, recomputed only when local midnight passes
+_TODAY_CACHE = {"s": "", "until": 0.0}
+
+def today_str() -> str:
+    """Cached str(date.today())"""
+    now = time.time()
+    if now >= _TODAY_CACHE["until"]:
+        today = date.today()
+        _TODAY_CACHE["s"] = str(today)
+        _TODAY_CACHE["until"] = datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+    return _TODAY_CACHE["s"]
+
+def _usage_entry(user_id: int) -> dict:
+    """Today's usage record for a user (reset in place on date rollover)"""
+    today = today_str()
+    entry = USER_DAILY_USAGE.setdefault(user_id, {"count": 0, "date": today})
+    if entry["date"] != today:
+        entry["count"] = 0
+        entry["date"] = today
+    return entry
+
+def compact_daily_usage():
+    """Drop usage records from previous days (they reset on next use anyway)"""
+    today = today_str()
+    stale = [uid for uid, usage in USER_DAILY_USAGE.items() if usage.get("date") != today]
+    for uid in stale:
+        del USER_DAILY_USAGE[uid]
+
+# Saves made while the bot is running are coalesced into one write per
+# PERSISTENCE_SAVE_DELAY seconds, performed off the event loop
+PERSISTENCE_SAVE_DELAY = 2.0
+PERSISTENCE_WRITE_LOCK = asyncio.Lock()
+_PERSIST_STATE = {"handle": None, "task": None}
+
+def _persistence_bytes() -> bytes:
+    """Serialize the persisted state (on the loop thread, so the dicts can't change mid-dump)"""
+    compact_daily_usage()
+    data = {
+        "user_lang": USER_LANG,
+        "user_usage": USER_DAILY_USAGE,
+        "search_file_id": SEARCH_FILE_ID
+    }
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8")
+
+def _atomic_write(path, data: bytes):
+    """Write via a temp file + os.replace so a crash never leaves a truncated file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+async def _flush_persistence():
+    _PERSIST_STATE["handle"] = None
     try:
-        data = {
-            "user_lang": USER_LANG,
-            "user_usage": USER_DAILY_USAGE,
-            "search_file_id": SEARCH_FILE_ID
-        }
-        with open(PERSISTENCE_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        data = _persistence_bytes()
+        async with PERSISTENCE_WRITE_LOCK:
+            await asyncio.to_thread(_atomic_write, PERSISTENCE_FILE, data)
     except Exception as e:
         logger.error(f"Persistence Save Error: {e}")
 
+def _start_persistence_flush():
+    _PERSIST_STATE["task"] = asyncio.create_task(_flush_persistence())
+
+def save_persistence():
+    """Save user languages and daily usage to file (debounced when the event loop is running)."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        try:
+            _atomic_write(PERSISTENCE_FILE, _persistence_bytes())
+        except Exception as e:
+            logger.error(f"Persistence Save Error: {e}")
+        return
+    if _PERSIST_STATE["handle"] is None:
+        _PERSIST_STATE["handle"] = loop.call_later(PERSISTENCE_SAVE_DELAY, _start_persistence_flush)
+
+async def flush_persistence():
+    """Write any pending debounced save now (used on shutdown)"""
+    handle = _PERSIST_STATE["handle"]
+    if handle is not None:
+        handle.cancel()
+        await _flush_persistence()
+    task = _PERSIST_STATE["task"]
+    if task is not None and not task.done():
+        await task
+
 def load_persistence():
     """Load user languages and daily usage from file."""
     global USER_LANG, USER_DAILY_USAGE
@@ -189,6 +472,7 @@ def load_persistence():
                 # Convert string keys back to int if needed (JSON keys are always strings)
                 USER_LANG = {int(k): v for k, v in data.get("user_lang", {}).items()}
                 USER_DAILY_USAGE = {int(k): v for k, v in data.get("user_usage", {}).items()}
+                compact_daily_usage()
                 global SEARCH_FILE_ID
                 SEARCH_FILE_ID = data.get("search_file_id")
                 logger.info(f"📁 Loaded persistence: {len(USER_LANG)} users, {len(USER_DAILY_USAGE)} usage, GIF: {'Exists' if SEARCH_FILE_ID else 'None'}")
@@ -256,7 +540,6 @@ def parse_smart_date(date_str: str):
             return (g_date.year, g_date.month, g_date.day, y, m, d, True)
         else:
             # GREGORIAN
-            from datetime import date
             # Validate existence
             date(y, m, d)
             return (y, m, d, None, None, None, False)
@@ -267,8 +550,7 @@ def parse_smart_date(date_str: str):
 
 def get_user_limit(user_id: int) -> int:
     """Get user's daily request limit."""
-    admin_id = SETTINGS["admin_id"]
-    if user_id == admin_id:
+    if user_id == ADMIN_ID:
         return 999  # Unlimited for admin
     
     # Whitelisted users get their custom limit or default
@@ -290,6 +572,11 @@ def extract_text(response) -> str:
     
     return str(content).strip()
 
+@functools.lru_cache(maxsize=4096)
+def _escape_paragraph(para: str) -> str:
+    """html.escape memoized per paragraph (the same analysis is split for /detail, /voice and captions)"""
+    return html.escape(para)
+
 def smart_split(text, header="", max_len=1024, overflow_prefix="... ادامه در پیام بعدی"):
     """
     Split text into two parts: a caption (max_len) and overflow_text.
@@ -299,70 +586,265 @@ def smart_split(text, header="", max_len=1024, overflow_prefix="... ادامه 
     if not text:
         return header, ""
         
-    # Split by paragraphs
+    # Pack paragraphs by running (escaped) length instead of re-escaping the
+    # whole candidate caption for every paragraph
     paragraphs = text.split('\n\n')
-    current_caption_raw = ""
-    overflow_text_raw = ""
-    overflow_started = False
-    
-    for para in paragraphs:
-        if overflow_started:
-            overflow_text_raw += ("\n\n" if overflow_text_raw else "") + para
-        else:
-            potential = (current_caption_raw + "\n\n" if current_caption_raw else "") + para
-            
-            # Test length with HTML escaping
-            test_caption_html = header + "\n\n" + html.escape(potential) + "\n\n<i>" + html.escape(overflow_prefix) + "</i>"
-            
-            if len(test_caption_html) <= max_len:
-                current_caption_raw = potential
+    overflow_html = "\n\n<i>" + html.escape(overflow_prefix) + "</i>"
+    budget = max_len - len(header) - 2 - len(overflow_html)
+    # Escaped paragraphs are kept as measured; escape() distributes over the
+    # "\n\n" joins, so the caption is never escaped a second time
+    kept = []
+    running = 0
+    overflow = []
+
+    for idx, para in enumerate(paragraphs):
+        # running == 0 means nothing kept yet (leading empty paragraphs collapse)
+        para_html = _escape_paragraph(para)
+        need = len(para_html) + (2 if running else 0)
+        if running + need <= budget:
+            if running:
+                kept.append(para_html)
             else:
-                if not current_caption_raw:
-                    # Hard split if first paragraph is too long
-                    allowed = max_len - len(header) - len(overflow_prefix) - 30
-                    current_caption_raw = para[:allowed]
-                    overflow_text_raw = para[allowed:]
-                    overflow_started = True
-                else:
-                    overflow_started = True
-                    overflow_text_raw = para
-                    
-    final_caption_html = header + (("\n\n" + html.escape(current_caption_raw)) if current_caption_raw else "")
+                kept = [para_html]
+            running += need
+            continue
+        if not running:
+            # Hard split if first paragraph is too long
+            allowed = max_len - len(header) - len(overflow_prefix) - 30
+            kept = [html.escape(para[:allowed])]
+            overflow = [para[allowed:]] + paragraphs[idx + 1:]
+        else:
+            overflow = paragraphs[idx:]
+        # Leading empty paragraphs collapse here too
+        while overflow and not overflow[0]:
+            overflow.pop(0)
+        break
+
+    caption_html = "\n\n".join(kept)
+    overflow_text_raw = "\n\n".join(overflow)
+
+    final_caption_html = header + (("\n\n" + caption_html) if caption_html else "")
     if overflow_text_raw:
-        final_caption_html += "\n\n<i>" + html.escape(overflow_prefix) + "</i>"
-        
+        final_caption_html += overflow_html
+
     return final_caption_html, overflow_text_raw
 
+async def send_overflow_text(bot, chat_id, text, title, reply_to_message_id, chat_type=None):
+    """Send smart_split's overflow as HTML follow-up messages, one 4000-char window at a time"""
+    for chunk in _chunk_markdown(text, 4000):
+        await tg_send(
+            bot.send_message,
+            chat_type=chat_type,
+            chat_id=chat_id,
+            text=f"📝 <b>{title}:</b>\n\n{html.escape(chunk)}",
+            parse_mode='HTML',
+            reply_to_message_id=reply_to_message_id
+        )
+
+# First fenced block in an LLM reply (``` or ```json)
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+
+def strip_code_fence(content: str) -> str:
+    """Return the contents of the first ``` fence, or the stripped text if there is none"""
+    m = _FENCE_RE.search(content)
+    return m.group(1) if m else content.strip()
+
+def parse_json(text):
+    """json.loads via orjson when available (orjson errors subclass ValueError too)"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def _chunk_markdown(text, limit=4000):
+    """Yield chunks of at most `limit` chars, cut at paragraph/line/word breaks so Markdown isn't split mid-token"""
+    start = 0
+    total = len(text)
+    while start < total:
+        end = min(start + limit, total)
+        if end < total:
+            # Prefer a paragraph break, then a line break, in the back half of the window
+            cut = text.rfind("\n\n", start, end)
+            if cut <= start + limit // 2:
+                cut = text.rfind("\n", start, end)
+            if cut <= start + limit // 2:
+                cut = text.rfind(" ", start, end)
+            if cut > start + limit // 2:
+                end = cut
+        yield text[start:end]
+        start = end
+
+# Telegram legacy Markdown: code spans are literal, * _ ` must pair up outside them
+_MD_CODE_SPAN_RE = re.compile(r'```.*?```|`[^`\n]*`', re.S)
+
+def _escape_last(text, marker):
+    """Backslash-escape the last unescaped `marker` in text"""
+    idx = len(text)
+    while True:
+        idx = text.rfind(marker, 0, idx)
+        if idx <= 0 or text[idx - 1] != "\\":
+            break
+    if idx < 0:
+        return text
+    return text[:idx] + "\\" + text[idx:]
+
+def _balance_markdown(text):
+    """Escape unpaired *, _, ` and [ so Telegram's Markdown parser accepts the text"""
+    parts = []
+    last = 0
+    for m in _MD_CODE_SPAN_RE.finditer(text):
+        parts.append((text[last:m.start()], False))
+        parts.append((m.group(0), True))
+        last = m.end()
+    parts.append((text[last:], False))
+
+    for marker in ("*", "_", "`"):
+        count = sum(
+            seg.count(marker) - seg.count("\\" + marker)
+            for seg, is_code in parts if not is_code
+        )
+        if count % 2:
+            # Escape the last unpaired marker in the last plain segment holding one
+            for i in range(len(parts) - 1, -1, -1):
+                seg, is_code = parts[i]
+                if not is_code and marker in seg:
+                    parts[i] = (_escape_last(seg, marker), False)
+                    break
+
+    # An unmatched "[" opens a link entity that never closes: escape them all
+    opens = sum(seg.count("[") for seg, is_code in parts if not is_code)
+    closes = sum(seg.count("]") for seg, is_code in parts if not is_code)
+    if opens != closes:
+        parts = [(seg if is_code else seg.replace("[", "\\["), is_code) for seg, is_code in parts]
+    return "".join(seg for seg, _ in parts)
+
+# Telegram-Markdown -> HTML. Code spans, links and escaped markers are set
+# aside as placeholders first; bold/italic never span a tag, so the output
+# is always well-formed HTML.
+_MD_PROTECT_RE = re.compile(
+    r'```(?:\w*\n)?(.*?)```|`([^`\n]+)`'
+    r'|\[([^\]\n]+)\]\((https?://[^\s)]+)\)'
+    r'|\\([*_`\[])',
+    re.S,
+)
+_MD_BOLD_RE = re.compile(r'\*\*([^*<>\n]+)\*\*|\*([^*<>\n]+)\*')
+_MD_ITALIC_RE = re.compile(r'(?<!\w)__?([^_<>\n]+)__?(?!\w)')
+_MD_PLACEHOLDER_RE = re.compile('\x00(\\d+)\x00')
+
+def markdown_to_html(text):
+    """Render the LLM's Markdown as Telegram HTML (no parse failures possible)"""
+    saved = []
+
+    def protect(m):
+        pre, code, label, url, escaped = m.groups()
+        if pre is not None:
+            saved.append(f"<pre>{html.escape(pre)}</pre>")
+        elif code is not None:
+            saved.append(f"<code>{html.escape(code)}</code>")
+        elif label is not None:
+            saved.append(f'<a href="{html.escape(url)}">{html.escape(label)}</a>')
+        else:
+            saved.append(escaped)
+        return f"\x00{len(saved) - 1}\x00"
+
+    out = html.escape(_MD_PROTECT_RE.sub(protect, text.replace("\x00", "")))
+    out = _MD_BOLD_RE.sub(lambda m: f"<b>{m.group(1) or m.group(2)}</b>", out)
+    out = _MD_ITALIC_RE.sub(r"<i>\1</i>", out)
+    return _MD_PLACEHOLDER_RE.sub(lambda m: saved[int(m.group(1))], out)
+
+def chunk_paragraphs(text, max_length):
+    """Group paragraphs into chunks of at most `max_length` chars (a single
+    oversized paragraph stays whole). Linear: each chunk is joined once."""
+    chunks = []
+    buf, buf_len = [], 0
+    for para in text.split('\n\n'):
+        # +2 for the "\n\n" separator
+        if buf and buf_len + len(para) + 2 > max_length:
+            chunks.append("\n\n".join(buf).strip())
+            buf, buf_len = [], 0
+        buf.append(para)
+        buf_len += len(para) + (2 if buf_len else 0)
+    if buf:
+        chunks.append("\n\n".join(buf).strip())
+    return [c for c in chunks if c]
+
+# Memoized results of the small AI helpers (translation, visual prompt,
+# language detection): repeated /voice <lang> on the same text skips the LLM
+AI_RESULT_CACHE = LRUDict(maxsize=512)
+
+def _ai_cache_key(kind: str, text: str, *extra) -> tuple:
+    """Compact cache key: a 16-byte digest instead of the (possibly long) text"""
+    return (kind, hashlib.blake2b(text.encode(), digest_size=16).digest(), *extra)
+
+# Script heuristics for detect_language (compiled once)
+_FA_ARABIC_RE = re.compile(r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]')
+_HANGUL_RE = re.compile(r'[\uAC00-\uD7AF\u1100-\u11FF]')
+# Latin text is only settled locally when it is unambiguous: French needs a
+# letter other Latin languages rarely use *and* French function words;
+# English needs pure ASCII with English function words. Everything else
+# (es/de/it/pt/tr, unaccented French, short snippets) goes to the AI call.
+_FR_LETTERS_RE = re.compile(r'[œæêâîôëïÿ]', re.I)
+_LATIN_WORD_RE = re.compile(r"[^\W\d_]+")
+_FR_STOPWORDS = frozenset({
+    "le", "la", "les", "des", "du", "une", "est", "et", "que", "qui", "pour",
+    "dans", "pas", "avec", "sur", "ce", "cette", "il", "elle", "nous", "vous",
+    "sont", "au", "aux", "mais", "être", "très",
+})
+_EN_STOPWORDS = frozenset({
+    "the", "and", "is", "are", "was", "were", "of", "that", "this", "for",
+    "with", "you", "have", "has", "what", "which", "they", "it", "not", "be",
+})
+
+def _stopword_share(words, stopwords) -> tuple[int, float]:
+    """(hits, hits / len(words)) for a list of lowercased words"""
+    hits = sum(1 for w in words if w in stopwords)
+    return hits, hits / len(words) if words else 0.0
+
 async def detect_language(text: str) -> str:
-    """Detect language of text. Prioritizes local regex for FA/KO, then AI."""
+    """Detect language of text. Prioritizes local regex for FA/KO/FR/EN, then AI."""
     if not text:
         return "fa"
         
     # Heuristic for Persian/Arabic
-    if re.search(r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]', text):
+    if _FA_ARABIC_RE.search(text):
         return "fa"
     
     # Heuristic for Korean (Hangul)
-    if re.search(r'[\uAC00-\uD7AF\u1100-\u11FF]', text):
+    if _HANGUL_RE.search(text):
         return "ko"
+
+    # Latin script: settle clear FR / EN locally (see _FR_LETTERS_RE)
+    head = text[:500]
+    words = _LATIN_WORD_RE.findall(head.lower())
+    if _FR_LETTERS_RE.search(head):
+        hits, share = _stopword_share(words, _FR_STOPWORDS)
+        if hits >= 2 and share >= 0.15:
+            return "fr"
+    elif head.isascii():
+        hits, share = _stopword_share(words, _EN_STOPWORDS)
+        if hits >= 2 and share >= 0.15:
+            return "en"
         
-    # Use AI for EN vs FR or others
+    # Use AI for other mixed-Latin text (only the first 100 chars are sent)
+    key = _ai_cache_key("lang", text[:100])
+    cached = AI_RESULT_CACHE.get(key)
+    if cached is not None:
+        return cached
     try:
         # Use a very short, fast prompt
         chain = get_smart_chain(grounding=False)
         response = await chain.ainvoke(f"Return only the 2-letter ISO code for this text's language: {text[:100]}")
         content = extract_text(response)
         code = content.lower()[:2]
-        return LANG_ALIASES.get(code, code) if code in LANG_ALIASES else code
+        code = LANG_ALIASES.get(code, code) if code in LANG_ALIASES else code
+        AI_RESULT_CACHE[key] = code
+        return code
     except:
         return "en"
 
 def check_access(user_id: int, chat_id: int = None) -> tuple[bool, str]:
     """Check if user has access to use the bot. Returns (allowed, reason)."""
-    admin_id = SETTINGS["admin_id"]
-    
     # Admin always has unlimited access
-    if user_id == admin_id:
+    if user_id == ADMIN_ID:
         return True, "admin"
     
     # Check if public mode
@@ -394,39 +876,31 @@ def check_daily_limit(user_id: int) -> tuple[bool, int]:
         return True, 999
     
     # Get today's usage
-    today = str(date.today())
-    if user_id not in USER_DAILY_USAGE or USER_DAILY_USAGE[user_id]["date"] != today:
-        USER_DAILY_USAGE[user_id] = {"count": 0, "date": today}
-    
-    current_count = USER_DAILY_USAGE[user_id]["count"]
+    current_count = _usage_entry(user_id)["count"]
     remaining = user_limit - current_count
     
     return remaining > 0, remaining
 
 def increment_daily_usage(user_id: int) -> int:
     """Increment user's daily usage count. Returns remaining requests."""
-    today = str(date.today())
-    if user_id not in USER_DAILY_USAGE or USER_DAILY_USAGE[user_id]["date"] != today:
-        USER_DAILY_USAGE[user_id] = {"count": 0, "date": today}
-    USER_DAILY_USAGE[user_id]["count"] += 1
+    entry = _usage_entry(user_id)
+    entry["count"] += 1
     save_persistence()
     
     # Return remaining
     user_limit = get_user_limit(user_id)
-    return user_limit - USER_DAILY_USAGE[user_id]["count"]
+    return user_limit - entry["count"]
 
 def get_status_text(user_id: int) -> str:
     """Generate localized status message for a user."""
-    dl_s = get_msg("dl_on", user_id) if SETTINGS["download"] else get_msg("dl_off", user_id)
-    fc_s = get_msg("fc_on", user_id) if SETTINGS["fact_check"] else get_msg("fc_off", user_id)
-    info = get_msg("status_fmt", user_id).format(dl=dl_s, fc=fc_s)
+    info = render_status_info(user_id)
     
     # Add user quota info
     has_quota, remaining = check_daily_limit(user_id)
     limit = get_user_limit(user_id)
     
     # Localized User Type
-    if user_id == SETTINGS["admin_id"]:
+    if user_id == ADMIN_ID:
         user_type = get_msg("user_type_admin", user_id)
     elif user_id in ALLOWED_USERS:
         user_type = get_msg("user_type_member", user_id)
@@ -474,7 +948,7 @@ class StatusUpdateCallback(AsyncCallbackHandler):
         
         try:
             user_id = getattr(self.status_msg, 'chat_id', 0)
-            text = get_msg("analyzing_model", user_id).format(model=model_raw)
+            text = format_msg("analyzing_model", user_id, model=model_raw)
             await self.status_msg.edit_text(text, parse_mode='Markdown')
             logger.info(f"📡 Trying model: {model_raw}")
         except Exception as e:
@@ -483,7 +957,8 @@ class StatusUpdateCallback(AsyncCallbackHandler):
 
 # User Preferences (In-Memory)
 USER_LANG = {}
-LEARN_LOCK = asyncio.Lock()  # Prevent concurrent /learn requests to avoid API 429s
+LEARN_CONCURRENCY = 4        # Concurrent /learn lessons (bounded to stay under the API's 429s)
+LEARN_SEM = asyncio.Semaphore(LEARN_CONCURRENCY)
 LEARN_WAITERS = []           # List of {user_id, status_msg, lang} for live queue updates
 # Fallback Tenor Animation (Direct link)
 SEARCH_GIF_FALLBACK = "https://media1.tenor.com/m/kI2WQAiG3KAAAAAC/waiting.gif"
@@ -538,7 +1013,7 @@ async def cmd_check_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Delete the command message itself if in a group
-    if msg.chat_id < 0:
+    if is_group_chat(msg):
         await safe_delete(msg)
 
     response = await analyze_text_gemini(target_text, status_msg, lang, user_id=user_id)
@@ -546,24 +1021,43 @@ async def cmd_check_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Increment usage and get remaining
     remaining = increment_daily_usage(user_id)
     
-    await smart_reply(msg, status_msg, response, user_id, lang)
-    
-    # Show remaining requests (skip for admin)
-    if user_id != SETTINGS["admin_id"]:
-        limit = get_user_limit(user_id)
-        # Use simple message for quota to avoid cluttering, or just log it
-        await reply_and_delete(update, context, f"📊 {remaining}/{limit} {get_msg('limit_remaining_count', user_id)}", delay=15, reply_to_message_id=status_msg.message_id)
+    # Remaining requests ride along in the reply itself (no extra message)
+    await smart_reply(msg, status_msg, response, user_id, lang,
+                      footer=quota_footer(user_id, remaining))
 
 # ==============================================================================
 # LOGIC: SMART CHAIN FACTORY (LANGCHAIN)
 # ==============================================================================
 
-def get_smart_chain(grounding=True):
+# One keep-alive pool for the DeepSeek fallback, shared by every chain variant,
+# so a fallback cascade reuses a warm TLS connection instead of reconnecting.
+DEEPSEEK_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+def get_deepseek_client() -> httpx.AsyncClient:
+    """Lazily create the pooled DeepSeek HTTP client"""
+    global DEEPSEEK_HTTP_CLIENT
+    if DEEPSEEK_HTTP_CLIENT is None or DEEPSEEK_HTTP_CLIENT.is_closed:
+        DEEPSEEK_HTTP_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+    return DEEPSEEK_HTTP_CLIENT
+
+def get_smart_chain(grounding=True, json_mode=False):
+    """Self-healing AI model chain (8-Layer Defense), built once per mode.
+    json_mode asks every provider for raw JSON output (no ``` fences)."""
+    return _build_smart_chain(bool(grounding), bool(json_mode))
+
+@functools.lru_cache(maxsize=4)
+def _build_smart_chain(grounding: bool, json_mode: bool = False):
     """Constructs the self-healing AI model chain (8-Layer Defense)"""
-    logger.info(f"⛓️ Building Smart AI Chain (Grounding: {grounding})...")
+    logger.info(f"⛓️ Building Smart AI Chain (Grounding: {grounding}, JSON: {json_mode})...")
     logger.info(f"🔑 Keys found: Gemini={'Yes' if GEMINI_API_KEY else 'No'}, DeepSeek={'Yes' if DEEPSEEK_API_KEY else 'No'}")
+    from langchain_google_genai import ChatGoogleGenerativeAI
     
     defaults = {"google_api_key": GEMINI_API_KEY, "temperature": 0.3}
+    if json_mode:
+        defaults["response_mime_type"] = "application/json"
 
     # 1. Gemini 3 Flash Preview (Primary - Experimental/Fast)
     primary = ChatGoogleGenerativeAI(
@@ -587,55 +1081,102 @@ def get_smart_chain(grounding=True):
     
     # 8. DeepSeek (Ultimate Fallback)
     if DEEPSEEK_API_KEY:
+        from langchain_openai import ChatOpenAI
         deepseek = ChatOpenAI(
             base_url="https://api.deepseek.com", 
             model="deepseek-chat", 
             api_key=DEEPSEEK_API_KEY,
-            temperature=0.3
+            temperature=0.3,
+            http_async_client=get_deepseek_client(),
+            **({"model_kwargs": {"response_format": {"type": "json_object"}}} if json_mode else {})
         )
         runnables.append(deepseek)
         
     return primary.with_fallbacks(runnables)
 
-# Global Cache for Details (Simple Dict: user_id -> detail_text)
-# In production, use a TTL cache or database.
-LAST_ANALYSIS_CACHE = {}
-
-import time
-
 def check_rate_limit(user_id):
     """Check if user can make AI request. Returns True if allowed."""
     now = time.time()
-    last_request = RATE_LIMIT.get(user_id, 0)
-    if now - last_request < RATE_LIMIT_SECONDS:
+    state = user_state(user_id)
+    if now - state.last_req_ts < RATE_LIMIT_SECONDS:
         return False
-    RATE_LIMIT[user_id] = now
+    state.last_req_ts = now
     return True
 
+# Queue changes within LEARN_QUEUE_REFRESH_DELAY are rendered together, and
+# a waiter's caption is only edited when its text actually changed
+LEARN_QUEUE_REFRESH_DELAY = 0.5
+_LEARN_QUEUE_REFRESH = {"task": None, "dirty": False}
+
 async def refresh_learn_queue():
-    """Update all waiting users about their position in the queue."""
-    for index, waiter in enumerate(LEARN_WAITERS):
-        try:
-            user_id = waiter["user_id"]
-            msg_obj = waiter["status_msg"]
-            
-            # Get the current slide progress if it's the active one
-            prog = waiter.get("progress", "")
-            base_text = get_msg("learn_designing", user_id)
-            if prog:
-                base_text = f"{base_text} ({prog})"
-            
-            # Position Label:
-            # If index is 0, they are the 'active' one (Position 1 in queue)
-            # but we only show the label to make it clear why it's not starting yet.
-            pos_label = get_msg("learn_queue_pos", user_id).format(pos=index + 1)
-            
-            await msg_obj.edit_caption(
-                caption=f"🪄 {base_text}{pos_label}",
-                parse_mode=ParseMode.MARKDOWN
-            )
-        except Exception:
-            pass
+    """Schedule a (coalesced) update of every waiting user's queue position."""
+    _LEARN_QUEUE_REFRESH["dirty"] = True
+    task = _LEARN_QUEUE_REFRESH["task"]
+    if task is None or task.done():
+        _LEARN_QUEUE_REFRESH["task"] = asyncio.create_task(_render_learn_queue())
+
+async def _render_learn_queue():
+    while _LEARN_QUEUE_REFRESH["dirty"]:
+        await asyncio.sleep(LEARN_QUEUE_REFRESH_DELAY)
+        _LEARN_QUEUE_REFRESH["dirty"] = False
+        # Snapshot: waiters may join/leave while the edits are awaited
+        for index, waiter in enumerate(list(LEARN_WAITERS)):
+            await _render_learn_waiter(index, waiter)
+
+async def _render_learn_waiter(index, waiter):
+    """Edit one waiter's status caption if its text changed"""
+    msg_obj = waiter["status_msg"]
+    if msg_obj is None:
+        return  # status message already replaced by the lesson
+    try:
+        user_id = waiter["user_id"]
+
+        # Get the current slide progress if it's the active one
+        prog = waiter.get("progress", "")
+        base_text = get_msg("learn_designing", user_id)
+        if prog:
+            base_text = f"{base_text} ({prog})"
+
+        # Position Label: the first LEARN_CONCURRENCY waiters are being
+        # served; only those behind them are shown a queue position
+        pos = index + 1 - LEARN_CONCURRENCY
+        pos_label = format_msg("learn_queue_pos", user_id, pos=pos) if pos > 0 else ""
+
+        text = f"🪄 {base_text}{pos_label}"
+        if text == waiter.get("last_text"):
+            return
+        waiter["last_text"] = text
+        await msg_obj.edit_caption(
+            caption=text,
+            parse_mode=ParseMode.MARKDOWN
+        )
+    except Exception:
+        pass
+
+# Shared, pooled HTTP client for image fetches (keeps TLS connections to
+# pollinations.ai / pexels alive between slides instead of a thread + handshake each)
+IMAGE_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+def get_image_client() -> httpx.AsyncClient:
+    """Lazily create the pooled image HTTP client"""
+    global IMAGE_HTTP_CLIENT
+    if IMAGE_HTTP_CLIENT is None or IMAGE_HTTP_CLIENT.is_closed:
+        IMAGE_HTTP_CLIENT = httpx.AsyncClient(
+            headers={"User-Agent": "Mozilla/5.0"},
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=8, max_keepalive_connections=8, keepalive_expiry=60),
+        )
+    return IMAGE_HTTP_CLIENT
+
+# Caps concurrent image generations/downloads instead of fixed per-slide sleeps
+IMG_SEM = asyncio.Semaphore(2)
+
+async def fetch_image_bytes(url: str, timeout: float = 60) -> bytes:
+    """GET `url` through the pooled client; raises on HTTP errors like urlopen did"""
+    async with IMG_SEM:
+        r = await get_image_client().get(url, timeout=timeout)
+    r.raise_for_status()
+    return r.content
 
 async def fetch_pexels_image(query: str) -> Optional[bytes]:
     """Fetch a high-quality image from Pexels API search fallback"""
@@ -648,14 +1189,10 @@ async def fetch_pexels_image(query: str) -> Optional[bytes]:
         encoded_query = urllib.parse.quote(query)
         url = f"https://api.pexels.com/v1/search?query={encoded_query}&per_page=1"
         
-        def call_pexels():
-            req = urllib.request.Request(url)
-            req.add_header("Authorization", PEXELS_API_KEY)
-            req.add_header("User-Agent", "Mozilla/5.0")
-            with urllib.request.urlopen(req, timeout=15) as r:
-                return json.loads(r.read())
-        
-        data = await asyncio.to_thread(call_pexels)
+        client = get_image_client()
+        r = await client.get(url, headers={"Authorization": PEXELS_API_KEY}, timeout=15)
+        r.raise_for_status()
+        data = r.json()
         photos = data.get("photos", [])
         if not photos:
             logger.warning("🌌 Pexels: No photos found.")
@@ -665,18 +1202,86 @@ async def fetch_pexels_image(query: str) -> Optional[bytes]:
         if not image_url:
             return None
             
-        def dl_pexels():
-            req = urllib.request.Request(image_url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req, timeout=30) as r:
-                return r.read()
-                
-        img_bytes = await asyncio.to_thread(dl_pexels)
+        img_bytes = await fetch_image_bytes(image_url, timeout=30)
         return img_bytes if img_bytes and len(img_bytes) > 5000 else None
         
     except Exception as e:
         logger.warning(f"🌌 Pexels API failed: {e}")
         return None
 
+def pollinations_url(prompt: str, seed: int) -> str:
+    """Pollinations image URL for a prompt (usable by Telegram directly or for download)"""
+    encoded = urllib.parse.quote(prompt, safe='')
+    return f"https://pollinations.ai/p/{encoded}?width=1024&height=1024&seed={seed}&nologo=true"
+
+async def warm_image_url(url: str, timeout: float = 90) -> None:
+    """Make the image host render `url` now, without pulling the body through this host"""
+    try:
+        async with IMG_SEM:
+            async with get_image_client().stream("GET", url, timeout=timeout) as r:
+                r.raise_for_status()
+    except Exception as e:
+        logger.debug("🌌 Image warm-up failed: %s", e)
+
+async def request_slide_prompts(target_text: str, target_lang: str) -> list[str]:
+    """Cheap early AI call: 3 English scene descriptions for the /learn images"""
+    try:
+        chain = get_smart_chain(grounding=False, json_mode=True)
+        prompt = (
+            f"Write 3 different short, vivid English visual scene descriptions for an AI image generator, "
+            f"each showing the meaning of the {target_lang} word or phrase '{target_text}' in everyday use. "
+            f"Return ONLY JSON: {{\"prompts\": [3 strings]}}"
+        )
+        response = await chain.ainvoke([HumanMessage(content=prompt)])
+        prompts = parse_json(strip_code_fence(extract_text(response))).get("prompts")
+        if isinstance(prompts, list):
+            return [str(p) for p in prompts[:3] if p]
+    except Exception as e:
+        logger.warning(f"⚠️ Early slide prompts failed: {e}")
+    return []
+
+async def fetch_learn_slide_image(i: int, img_prompt: str, keywords: str, seed: int) -> Optional[bytes]:
+    """Per-slide image download (Pollinations -> Pexels -> keyword Pollinations fallback)"""
+    image_bytes = None
+    max_retries = 3 # Increased retries
+    for attempt in range(max_retries + 1):
+        try:
+            if attempt > 0: await asyncio.sleep(2 ** (attempt - 1))  # 1s, 2s, 4s backoff
+            url = pollinations_url(img_prompt, seed + (attempt * 15))
+
+            # Increased timeout to 90s for reliability
+            image_bytes = await fetch_image_bytes(url, timeout=90)
+            if image_bytes and len(image_bytes) > 5000: break # Success
+
+            # If pollination fails on last attempt, try Pexels
+            if attempt == max_retries:
+                logger.info("🛡️ Pollinations failed. Trying Pexels Fallback for slide %d...", i + 1)
+                image_bytes = await fetch_pexels_image(keywords)
+                if image_bytes: break
+
+                # FINAL FALLBACK: Try Pollinations again but with simple keywords (less chance of 414 URI Too Long)
+                logger.info("🛡️ Pexels failed. Trying Final Pollinations Fallback with keywords: %s", keywords)
+                try:
+                    url_kw = pollinations_url(keywords, seed + 999)
+                    image_bytes = await fetch_image_bytes(url_kw, timeout=60)
+                    if image_bytes and len(image_bytes) > 5000: break
+                except Exception as e_kw:
+                    logger.warning(f"Final fallback failed: {e_kw}")
+
+        except Exception as e:
+            logger.warning(f"Image {i} attempt {attempt+1} failed: {e}")
+            # Fallback to Pexels immediately if it's a connection error from Pollinations
+            if "pollinations.ai" in str(e):
+                try:
+                    logger.info("🛡️ Immediate Fallback to Pexels for slide %d...", i + 1)
+                    image_bytes = await fetch_pexels_image(keywords)
+                    if image_bytes: break
+                except: pass
+
+            if attempt == max_retries:
+                logger.error(f"Image {i} permanently failed after {max_retries+1} attempts.")
+    return image_bytes
+
 async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Educational tutor: 3 variations with images, definitions, and sentence audio."""
     msg = update.effective_message
@@ -696,20 +1301,12 @@ async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_text = ""
     target_lang = user_lang # Default to user's app language
     
+    # First arg may be a language code/alias
+    target_lang, arg_text = _parse_lang_arg(context.args, target_lang)
     if msg.reply_to_message:
         target_text = msg.reply_to_message.text or msg.reply_to_message.caption or ""
-        if context.args:
-            lang_arg = context.args[0].lower()
-            if lang_arg in LANG_ALIASES:
-                target_lang = LANG_ALIASES[lang_arg]
-    elif context.args:
-        # Check if first arg is a language code/alias
-        lang_arg = context.args[0].lower()
-        if lang_arg in LANG_ALIASES:
-            target_lang = LANG_ALIASES[lang_arg]
-            target_text = " ".join(context.args[1:])
-        else:
-            target_text = " ".join(context.args)
+    else:
+        target_text = arg_text
 
     if not target_text:
         await msg.reply_text(get_msg("learn_no_text", user_id))
@@ -730,7 +1327,7 @@ async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not SEARCH_FILE_ID and status_msg.animation:
             SEARCH_FILE_ID = status_msg.animation.file_id
             save_persistence()
-            logger.info(f"🚀 Captured and cached Search GIF file_id: {SEARCH_FILE_ID}")
+            logger.info("🚀 Captured and cached Search GIF file_id: %s", SEARCH_FILE_ID)
     except Exception as e:
         logger.error(f"GIF status failed: {e}")
         # Clear cache if it failed, maybe the file_id is invalid
@@ -744,111 +1341,215 @@ async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     LEARN_WAITERS.append(waiter_entry)
     await refresh_learn_queue()
 
-    # 4. Wait for Global Lock
-    async with LEARN_LOCK:
-        try:
-            await refresh_learn_queue()
-        except: pass
-            
+    # 4. Wait for a free lesson slot
+    cache_key = inflight = None
+    async with LEARN_SEM:
         try:
-            # 4. Educational AI Call
-            logger.info(f"🤖 Step 1: Requesting deep educational content from AI in {target_lang}...")
-            lang_name = LANG_NAMES.get(target_lang, target_lang)
-            explanation_lang = "Persian" if user_lang == "fa" else ("English" if user_lang == "en" else ("French" if user_lang == "fr" else "Korean"))
-            chain = get_smart_chain(grounding=False)
+            # Identical lessons (same text + languages) are served from cache;
+            # concurrent identical requests wait for the one generating it
+            cache_key = (target_text.strip().lower(), target_lang, user_lang)
+            cacheable = False
+            photo_ids = None
+            warm_tasks = []
+            audio_tasks = []
+            while True:
+                cached = LEARN_RESULT_CACHE.get(cache_key)
+                fresh = bool(cached) and time.time() - cached[0] < LEARN_RESULT_TTL_SECONDS
+                pending = None if fresh else LEARN_INFLIGHT.get(cache_key)
+                if pending is None:
+                    break
+                logger.info("⏳ Waiting for identical in-flight lesson '%s' (%s)", target_text, target_lang)
+                await asyncio.shield(pending)
+            if fresh:
+                logger.info("♻️ Serving cached lesson for '%s' (%s)", target_text, target_lang)
+                _, variations, seed_base, photo_ids = cached
+            else:
+                inflight = LEARN_INFLIGHT[cache_key] = asyncio.get_running_loop().create_future()
+                # 4. Educational AI Call
+                logger.info("🤖 Step 1: Requesting deep educational content from AI in %s...", target_lang)
+                explanation_lang = _EXPLANATION_LANGS.get(user_lang, "Korean")
+                chain = get_smart_chain(grounding=False, json_mode=True)
             
-            educational_prompt = (
-                f"SYSTEM ROLE: You are a linguistic tutor. Your student's interface language is '{explanation_lang}'.\n\n"
-                f"CORE TASK: The student wants to learn about the concept: '{target_text}' in '{target_lang}'.\n\n"
-                f"STRICT LANGUAGE MAPPING (FAILURE TO COMPLY IS UNACCEPTABLE):\n"
-                f"1. 'word': MUST be the translation of '{target_text}' into '{target_lang}'.\n"
-                f"2. 'sentence': MUST be a complete example sentence ONLY in '{target_lang}'.\n"
-                f"3. 'meaning': MUST be a definition/explanation written ONLY in '{explanation_lang}'.\n"
-                f"4. 'translation': MUST be the translation of the 'sentence' (field #2) ONLY into '{explanation_lang}'.\n\n"
-                f"IMPORTANT: Even if the input '{target_text}' is in '{explanation_lang}' or any other language, you MUST provide ALL explanations (meaning/translation) in '{explanation_lang}'.\n\n"
-                f"GRAMMAR RULES (CRITICAL):\n"
-                f"- Use 'Triple Format' (Indefinite / Definite / Plural) ONLY for languages with articles (e.g., English, French, German).\n"
-                f"- For others (e.g., Persian, Korean, Japanese), provide the word in its MOST NATURAL dictionary form. DO NOT force 3 forms if they don't exist.\n"
-                f"- CRITICAL: The 'meaning' field MUST be in '{explanation_lang}'. If providing definitions for Korean/Japanese terms, the definition MUST be in '{explanation_lang}' (e.g., Persian).\n"
-                f"- If '{target_lang}' is the same as '{explanation_lang}', the 'translation' field should be empty or null to avoid redundancy.\n"
-                f"- Include phonetics for the '{target_lang}' word.\n\n"
-                f"Return ONLY valid JSON in this structure:\n"
-                f"{{\n"
-                f"  \"valid\": true/false,\n"
-                f"  \"lang\": \"detected language of '{target_text}'\",\n"
-                f"  \"lang_code\": \"ISO code\",\n"
-                f"  \"dict\": \"source dictionary\",\n"
-                f"  \"is_correction\": true/false,\n"
-                f"  \"suggestion\": \"corrected '{target_text}' if misspelled\",\n"
-                f"  \"slides\": [\n"
-                f"    {{\n"
-                f"      \"word\": \"[{target_lang} terms]\",\n"
-                f"      \"phonetic\": \"...\",\n"
-                f"      \"meaning\": \"[Explanations ONLY in {explanation_lang}]\",\n"
-                f"      \"sentence\": \"[{target_lang} sentence]\",\n"
-                f"      \"translation\": \"[Translation ONLY in {explanation_lang}]\",\n"
-                f"      \"prompt\": \"A highly detailed English visual description for an AI image generator. IMPORTANT: This description MUST be based on the EXACT context and scene described in the 'sentence' and 'meaning' fields. DO NOT just describe the word. Create a vivid, high-quality cinematic scene representing the concept.\",\n"
-                f"      \"keywords\": \"3-4 simple English keywords representing the scene for image search\"\n"
-                f"    }},\n"
-                f"    ... (exactly 3 variant objects)\n"
-                f"  ]\n"
-                f"}}\n"
-                f"REPLY ONLY WITH JSON."
-            )
+                educational_prompt = build_educational_prompt(target_text, target_lang, explanation_lang)
             
-            response = await chain.ainvoke([HumanMessage(content=educational_prompt)])
-            content = extract_text(response)
+                seed_base = time.monotonic_ns() & 0xFFFFFFFF
+                early_prompts = []
+                early_warm_tasks = []
+                hit = await lookup_ai_answer(educational_prompt)
+                if hit:
+                    content = hit[0]
+                else:
+                    # Overlap the two slow steps: while the full lesson is generated, a
+                    # cheap call supplies fallback image prompts whose renders start right away.
+                    full_task = asyncio.create_task(
+                        chain.ainvoke([HumanMessage(content=educational_prompt)])
+                    )
+                    early_prompts = await request_slide_prompts(target_text, target_lang)
+                    early_warm_tasks = [
+                        asyncio.create_task(warm_image_url(pollinations_url(p, seed_base + i)))
+                        for i, p in enumerate(early_prompts)
+                    ]
+                    content = extract_text(await full_task)
             
-            # Clean JSON
-            if "```json" in content: content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content: content = content.split("```")[1].split("```")[0].strip()
+                # JSON mode returns bare JSON; a fence can still slip through on fallbacks
+                content = strip_code_fence(content)
                 
-            try:
-                res = json.loads(content)
-                if not res.get("valid"):
-                    await status_msg.edit_caption(
-                        caption=get_msg("learn_word_not_found_no_suggestion", user_id).format(word=target_text),
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    return
+                try:
+                    res = parse_json(content)
+                    if not res.get("valid"):
+                        await status_msg.edit_caption(
+                            caption=get_msg("learn_word_not_found_no_suggestion", user_id).format(word=target_text),
+                            parse_mode=ParseMode.MARKDOWN
+                        )
+                        return
 
-                det_lang = res.get("lang", "Unknown")
-                det_lang_code = res.get("lang_code", target_lang)
-                det_dict = res.get("dict", "General")
+                    det_lang = res.get("lang", "Unknown")
+                    det_dict = res.get("dict", "General")
                 
-                if res.get("is_correction"):
-                    suggestion = res.get("suggestion", target_text)
-                    await status_msg.edit_caption(
-                        caption=get_msg("learn_word_not_found", user_id).format(word=target_text, suggestion=suggestion, lang=det_lang, dict=det_dict),
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    await status_msg.edit_caption(
-                        caption=get_msg("learn_searching_stats", user_id).format(word=target_text, lang=det_lang, dict=det_dict),
-                        parse_mode=ParseMode.MARKDOWN
-                    )
+                    if res.get("is_correction"):
+                        suggestion = res.get("suggestion", target_text)
+                        await status_msg.edit_caption(
+                            caption=get_msg("learn_word_not_found", user_id).format(word=target_text, suggestion=suggestion, lang=det_lang, dict=det_dict),
+                            parse_mode=ParseMode.MARKDOWN
+                        )
+                    else:
+                        await status_msg.edit_caption(
+                            caption=get_msg("learn_searching_stats", user_id).format(word=target_text, lang=det_lang, dict=det_dict),
+                            parse_mode=ParseMode.MARKDOWN
+                        )
 
-                # Extract slides
-                variations = res.get("slides")
-                if not variations or not isinstance(variations, list): raise ValueError("Empty slides")
-                variations = variations[:3]
-
-            except Exception:
-                # Basic fallback
-                translated_text = await translate_text(target_text, target_lang)
-                img_prompt = await generate_visual_prompt(target_text)
-                variations = [{
-                    "word": translated_text,
-                    "phonetic": "",
-                    "meaning": get_msg("learn_fallback_meaning", user_id),
-                    "sentence": "Example sentence goes here.",
-                    "translation": get_msg("learn_fallback_translation", user_id),
-                    "prompt": img_prompt
-                }]
+                    # Extract slides
+                    variations = res.get("slides")
+                    if not variations or not isinstance(variations, list): raise ValueError("Empty slides")
+                    variations = variations[:3]
+                    cacheable = True
+                    await store_ai_answer(educational_prompt, content)
+
+                except Exception:
+                    # Basic fallback
+                    translated_text = await translate_text(target_text, target_lang)
+                    img_prompt = await generate_visual_prompt(target_text)
+                    variations = [{
+                        "word": translated_text,
+                        "phonetic": "",
+                        "meaning": get_msg("learn_fallback_meaning", user_id),
+                        "sentence": "Example sentence goes here.",
+                        "translation": get_msg("learn_fallback_translation", user_id),
+                        "prompt": img_prompt
+                    }]
+
+                # Each slide keeps the lesson's own scene prompt; the early prompts
+                # only fill in for slides that came back without one
+                for i, var in enumerate(variations):
+                    if not var.get("prompt") and i < len(early_prompts):
+                        var["prompt"] = early_prompts[i]
+
+                # Keep the early renders that are actually used, warm the rest
+                for i, task in enumerate(early_warm_tasks):
+                    if i < len(variations) and variations[i].get("prompt") == early_prompts[i]:
+                        warm_tasks.append(task)
+                    else:
+                        task.cancel()
+                warm_tasks += [
+                    asyncio.create_task(warm_image_url(pollinations_url(var["prompt"], seed_base + i)))
+                    for i, var in enumerate(variations)
+                    if var.get("prompt") and not (i < len(early_prompts) and var["prompt"] == early_prompts[i])
+                ]
 
             # 5. Sequential Delivery (Download & Send one-by-one)
             logger.info("🎬 Starting sequential delivery to avoid timeouts...")
-            
+
+            def build_slide_caption(i, var):
+                word = var.get("word", "")
+                sentence = var.get("sentence", "")
+                translation = var.get("translation", "")
+                target_flag = LANG_FLAGS.get(target_lang, "🌐")
+                user_flag = LANG_FLAGS.get(user_lang, "🇮🇷")
+
+                translation_line = f"{user_flag} {translation}\n\n"
+                # Hide translation if redundant (same language or identical text)
+                if user_lang == target_lang or (translation and sentence and translation.strip() == sentence.strip()):
+                    translation_line = "\n"
+
+                return (
+                    f"💡 **{word}** {var.get('phonetic', '')}\n"
+                    f"📝 {var.get('meaning', '')}\n\n"
+                    f"{get_msg('learn_example_sentence', user_id)}\n"
+                    f"{target_flag} `{sentence}`\n"
+                    f"{translation_line}"
+                    f"━━━━━━━━━━━━━━\n{format_msg('learn_slide_footer', user_id, index=i+1)}"
+                )
+
+            captions = [build_slide_caption(i, var) for i, var in enumerate(variations)]
+
+            # Every slide's audio synthesizes in the background while the images
+            # are fetched and sent; the loop below only awaits them in order.
+            audio_tasks = [
+                asyncio.create_task(learn_slide_audio(
+                    f"{var.get('word', '')}. {var.get('sentence', '')}", target_lang,
+                    var.get("translation", ""), user_lang
+                ))
+                for var in variations
+            ]
+
+            # Fastest path: let Telegram fetch the images from Pollinations itself,
+            # so the bytes never pass through this host (once the renders are warm).
+            if warm_tasks:
+                await asyncio.wait(warm_tasks, timeout=60)
+            album_msgs = None
+            images = [None] * len(variations)
+            try:
+                album_msgs = await context.bot.send_media_group(
+                    chat_id=msg.chat_id,
+                    media=[
+                        InputMediaPhoto(
+                            media=photo_ids[i] if photo_ids else pollinations_url(var.get("prompt", target_text), seed_base + i),
+                            caption=captions[i], parse_mode='Markdown'
+                        )
+                        for i, var in enumerate(variations)
+                    ],
+                    reply_to_message_id=original_msg_id,
+                    read_timeout=150
+                )
+            except Exception as url_e:
+                # e.g. WEBPAGE_MEDIA_EMPTY / failed to get HTTP URL content
+                logger.info("🌐 Telegram couldn't fetch images by URL, downloading instead: %s", url_e)
+
+            # Fallback: download every slide's image concurrently, then upload
+            # them all in one sendMediaGroup round-trip if they're all valid.
+            if not album_msgs:
+                images = await asyncio.gather(*(
+                    fetch_learn_slide_image(
+                        i, var.get("prompt", target_text), var.get("keywords", target_text),
+                        seed_base + i
+                    )
+                    for i, var in enumerate(variations)
+                ))
+            if not album_msgs and images and all(
+                b and (b.startswith(b'\xff\xd8') or b.startswith(b'\x89PNG')) for b in images
+            ):
+                try:
+                    album_msgs = await context.bot.send_media_group(
+                        chat_id=msg.chat_id,
+                        media=[
+                            InputMediaPhoto(media=b, caption=c, parse_mode='Markdown', filename=f"learn_{i}.jpg")
+                            for i, (b, c) in enumerate(zip(images, captions))
+                        ],
+                        reply_to_message_id=original_msg_id,
+                        read_timeout=150
+                    )
+                except Exception as album_e:
+                    logger.warning(f"📸 Album send failed, falling back to per-slide send: {album_e}")
+                    album_msgs = None
+
+            if cacheable:
+                # Reuse Telegram's file_ids next time: no image fetch or upload at all
+                if album_msgs and all(m.photo for m in album_msgs):
+                    photo_ids = [m.photo[-1].file_id for m in album_msgs]
+                LEARN_RESULT_CACHE[cache_key] = (time.time(), variations, seed_base, photo_ids)
+            # Waiters re-check the cache now (a failed lesson lets them generate their own)
+            _release_learn_inflight(cache_key, inflight)
+
             for i, var in enumerate(variations):
                 # Update progress for queue visibility
                 waiter_entry["progress"] = f"{i+1}/3"
@@ -856,100 +1557,28 @@ async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 # If this is the start of sending real content, remove the temporary status GIF
                 if i == 0 and status_msg:
+                    waiter_entry["status_msg"] = None  # nothing left to edit for this waiter
                     await safe_delete(status_msg)
                     status_msg = None # Clear to avoid trying to delete again later
 
-                if i > 0: await asyncio.sleep(3.5)
-                    
                 word = var.get("word", "")
-                phonetic = var.get("phonetic", "")
-                meaning = var.get("meaning", "")
-                sentence = var.get("sentence", "")
-                translation = var.get("translation", "")
-                img_prompt = var.get("prompt", target_text)
-                keywords = var.get("keywords", target_text)
-                
-                # --- Per-Slide Image Download (Pollinations -> Unsplash Fallback) ---
-                image_bytes = None
-                max_retries = 3 # Increased retries
-                for attempt in range(max_retries + 1):
-                    try:
-                        if attempt > 0: await asyncio.sleep(attempt * 1.5)
-                        encoded = urllib.parse.quote(img_prompt)
-                        seed = int(asyncio.get_event_loop().time()) + i + (attempt * 15)
-                        url = f"https://pollinations.ai/p/{encoded}?width=1024&height=1024&seed={seed}&nologo=true"
-                        
-                        def dl():
-                            req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-                            # Increased timeout to 90s for reliability
-                            with urllib.request.urlopen(req, timeout=90) as r: return r.read()
-                        
-                        image_bytes = await asyncio.to_thread(dl)
-                        if image_bytes and len(image_bytes) > 5000: break # Success
-                        
-                        # If pollination fails on last attempt, try Pexels
-                        if attempt == max_retries:
-                            logger.info(f"🛡️ Pollinations failed. Trying Pexels Fallback for slide {i+1}...")
-                            image_bytes = await fetch_pexels_image(keywords)
-                            if image_bytes: break
-                            
-                            # FINAL FALLBACK: Try Pollinations again but with simple keywords (less chance of 414 URI Too Long)
-                            logger.info(f"🛡️ Pexels failed. Trying Final Pollinations Fallback with keywords: {keywords}")
-                            try:
-                                encoded_kw = urllib.parse.quote(keywords)
-                                seed_kw = int(asyncio.get_event_loop().time()) + 999
-                                url_kw = f"https://pollinations.ai/p/{encoded_kw}?width=1024&height=1024&seed={seed_kw}&nologo=true"
-                                def dl_kw():
-                                    req = urllib.request.Request(url_kw, headers={'User-Agent': 'Mozilla/5.0'})
-                                    with urllib.request.urlopen(req, timeout=60) as r: return r.read()
-                                image_bytes = await asyncio.to_thread(dl_kw)
-                                if image_bytes and len(image_bytes) > 5000: break
-                            except Exception as e_kw:
-                                logger.warning(f"Final fallback failed: {e_kw}")
-
-                    except Exception as e:
-                        logger.warning(f"Image {i} attempt {attempt+1} failed: {e}")
-                        # Fallback to Pexels immediately if it's a connection error from Pollinations
-                        if "pollinations.ai" in str(e):
-                            try:
-                                logger.info(f"🛡️ Immediate Fallback to Pexels for slide {i+1}...")
-                                image_bytes = await fetch_pexels_image(keywords)
-                                if image_bytes: break
-                            except: pass
-
-                        if attempt == max_retries:
-                            logger.error(f"Image {i} permanently failed after {max_retries+1} attempts.")
+                caption = captions[i]
+                image_bytes = images[i]
 
                 try:
-                    target_flag = LANG_FLAGS.get(target_lang, "🌐")
-                    user_flag = LANG_FLAGS.get(user_lang, "🇮🇷")
-                    
-                    translation_line = f"{user_flag} {translation}\n\n"
-                    # Hide translation if redundant (same language or identical text)
-                    if user_lang == target_lang or (translation and sentence and translation.strip() == sentence.strip()):
-                        translation_line = "\n"
-
-                    caption = (
-                        f"💡 **{word}** {phonetic}\n"
-                        f"📝 {meaning}\n\n"
-                        f"{get_msg('learn_example_sentence', user_id)}\n"
-                        f"{target_flag} `{sentence}`\n"
-                        f"{translation_line}"
-                        f"━━━━━━━━━━━━━━\n{get_msg('learn_slide_footer', user_id).format(index=i+1)}"
-                    )
-
                     current_slide_msg = None
-                    if image_bytes:
+                    if album_msgs:
+                        current_slide_msg = album_msgs[i]
+                    elif image_bytes:
                         # Basic image validation (check for JPEG/PNG magic numbers)
                         is_valid_image = image_bytes.startswith(b'\xff\xd8') or image_bytes.startswith(b'\x89PNG')
                         
                         if is_valid_image:
                             try:
-                                photo_buffer = io.BytesIO(image_bytes)
-                                photo_buffer.name = f"learn_{i}.jpg"
                                 current_slide_msg = await context.bot.send_photo(
                                     chat_id=msg.chat_id,
-                                    photo=photo_buffer,
+                                    photo=image_bytes,
+                                    filename=f"learn_{i}.jpg",
                                     caption=caption,
                                     parse_mode='Markdown',
                                     reply_to_message_id=original_msg_id,
@@ -980,16 +1609,9 @@ async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             reply_to_message_id=original_msg_id
                         )
                     
-                    # Audio (linked to the SLIDE)
-                    # 1. Target Language (Word + Sentence)
-                    target_tts = f"{word}. {sentence}"
-                    target_audio_buf = await text_to_speech(target_tts, target_lang)
-                    
-                    # 2. Interface Language (Translation)
-                    trans_audio_buf = await text_to_speech(translation, user_lang)
-                    
-                    # 3. Merge them (Podcast Style)
-                    final_audio_buf = await merge_bilingual_audio(target_audio_buf, trans_audio_buf)
+                    # Audio (linked to the SLIDE): target word + sentence, then
+                    # the translation, merged podcast style (prefetched above)
+                    final_audio_buf = await audio_tasks[i]
                     
                     if final_audio_buf and current_slide_msg:
                         await context.bot.send_voice(
@@ -1001,7 +1623,7 @@ async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         )
 
                 except Exception as item_e:
-                    logger.info(f"❌ Error sending item {i+1}: {item_e}")
+                    logger.info("❌ Error sending item %d: %s", i + 1, item_e)
                     try:
                         await context.bot.send_message(
                             chat_id=msg.chat_id,
@@ -1013,19 +1635,263 @@ async def cmd_learn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not IS_DEV:
                 await safe_delete(status_msg)
             
-            # FINISHED: Remove from waiters and refresh positions for others
-            if waiter_entry in LEARN_WAITERS:
-                LEARN_WAITERS.remove(waiter_entry)
-            await refresh_learn_queue()
-            
             increment_daily_usage(user_id)
             
         except Exception as e:
             logger.error(f"Learn Loop Error: {e}")
+            for task in warm_tasks + audio_tasks:
+                task.cancel()
             try:
                 await status_msg.edit_text(get_msg("learn_error", user_id))
             except: pass
+        finally:
+            _release_learn_inflight(cache_key, inflight)
+            # FINISHED (or failed/returned early): leave the queue and refresh
+            # positions for the others
+            if waiter_entry in LEARN_WAITERS:
+                LEARN_WAITERS.remove(waiter_entry)
+            await refresh_learn_queue()
+
+
+# Map lang_code to English name for the analysis prompt
+ANALYSIS_LANG_MAP = {"fa": "Persian (Farsi)", "en": "English", "fr": "French"}
+
+# Language-specific labels for the comparison table (French is the fallback)
+LANG_LABELS: dict[str, dict[str, str]] = {
+    "fa": {
+        "overall_status": "**وضعیت کلی:**",
+        "comparison_table": "**جدول مقایسه:**",
+        "text_claim": "▫️ **ادعای متن:**",
+        "research": "▫️ **مقالات:**",
+        "conclusion": "▫️ **نتیجه تحقیقات:**",
+        "status": "▫️ **وضعیت:**",
+        "result": "**نتیجه:**",
+        "example_conclusion1": "تحقیقات این میزان خستگی را تأیید می‌کند",
+        "example_conclusion2": "تحقیقات کاهش تمرکز را نشان می‌دهد اما درصد دقیق متفاوت است",
+        "example_not_specified": "در تحقیقات مشخص نشده",
+    },
+    "en": {
+        "overall_status": "**Overall Status:**",
+        "comparison_table": "**Comparison Table:**",
+        "text_claim": "▫️ **Text Claim:**",
+        "research": "▫️ **Research Papers:**",
+        "conclusion": "▫️ **Research Findings:**",
+        "status": "▫️ **Status:**",
+        "result": "**Conclusion:**",
+        "example_conclusion1": "Research confirms fatigue increases by this amount",
+        "example_conclusion2": "Research shows concentration decreases but exact percentage varies",
+        "example_not_specified": "Not specified in research",
+    },
+    "fr": {
+        "overall_status": "**Statut Global:**",
+        "comparison_table": "**Tableau de Comparaison:**",
+        "text_claim": "▫️ **Affirmation du Texte:**",
+        "research": "▫️ **Articles:**",
+        "conclusion": "▫️ **Résultats de Recherche:**",
+        "status": "▫️ **Statut:**",
+        "result": "**Conclusion:**",
+        "example_conclusion1": "La recherche confirme cette augmentation de fatigue",
+        "example_conclusion2": "La recherche montre une diminution de concentration mais le pourcentage exact varie",
+        "example_not_specified": "Non spécifié dans la recherche",
+    },
+}
+
+
+def _build_analysis_prompt(lang_code):
+    """Static fact-check prompt for a language; the text to analyze is appended at the end"""
+    target_lang = ANALYSIS_LANG_MAP.get(lang_code, "Persian")
+    labels = LANG_LABELS.get(lang_code, LANG_LABELS["fr"])
+    return (
+        f"You are a professional Fact-Check Assistant. Analyze the following text and provide your response STRICTLY in **{target_lang}**.\n\n"
+
+        "🛑 STRICT RELEVANCE FILTER (CRITICAL):\n"
+        "You must internalize these 3 rules to decide if you need to output '|||IRRELEVANT|||':\n\n"
+        "#### 1. REJECTION CRITERIA (Mark as IRRELEVANT)\n"
+        "Reject the input if it falls into any of these categories:\n"
+        "* **Political Commentary & News Analysis:** Debates, opinions on government policies, or praising/criticizing politicians (e.g., 'Policy X is a failure').\n"
+        "* **Social & Cultural Criticism:** Rants or general statements about society and human behavior (e.g., 'People are lazier these days').\n"
+        "* **Personal Opinions & Beliefs:** Subjective claims, personal defenses, or 'I think/believe' statements.\n"
+        "* **Conversational Fillers:** Jokes, sarcasm, greetings, or rhetorical questions that do not seek a factual answer.\n"
+        "* **General/Philosophical Statements:** Abstract or existential claims (e.g., 'Life is a journey').\n\n"
+        "#### 2. ACCEPTANCE CRITERIA\n"
+        "Accept the input **ONLY** if it meets the following condition:\n"
+        "* The text makes a **specific, objective, and verifiable claim** regarding **Science, Medicine, History, or Statistics**.\n\n"
+        "#### 3. CORE RULES\n"
+        "* **Dominant Intent:** If the text is primarily political or social commentary, **REJECT IT** even if it contains minor factual references.\n"
+        "* **Threshold of Doubt:** If you are unsure whether a claim is verifiable or if it is just a debate topic, **REJECT IT as IRRELEVANT**.\n"
+        "* **Final Action:** Only proceed to fact-check if there is a concrete claim about reality that can be proven or disproven by evidence.\n\n"
+        "Output ONLY '|||IRRELEVANT|||' if rejection criteria are met.\n"
+        "|||IRRELEVANT|||\n\n"
+        "CRITICAL FORMATTING RULES:\n"
+        "1. Your response MUST be split into TWO parts using: |||SPLIT|||\n"
+        "2. Use ✅ emoji ONLY for TRUE/VERIFIED claims\n"
+        "3. Use ❌ emoji ONLY for FALSE/INCORRECT claims\n"
+        "4. Use ⚠️ emoji for PARTIALLY TRUE/MISLEADING claims\n"
+        "5. DO NOT use bullet points (•) or asterisks (*) - Telegram doesn't support them well\n"
+        "6. Add blank lines between paragraphs for readability\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        "PART 1: SUMMARY (VERY SHORT - Mobile Display)\n"
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        "IMPORTANT: Keep this section VERY SHORT (max 500 words)\n"
+        "RULE: If the text contains only ONE simple claim, analyze ONLY that claim. DO NOT invent 'implied' claims unless they are dangerous or misleading.\n"
+        f"Format EXACTLY like this:\n\n"
+        f"{labels['overall_status']} [✅/⚠️/❌]\n\n"
+        f"{labels['comparison_table']}\n"
+        "━━━━━━━━━━━━━━\n"
+        f"{labels['text_claim']} 17%\n"
+        f"{labels['research']} 17.1%\n"
+        f"{labels['conclusion']} {labels['example_conclusion1']}\n"
+        f"{labels['status']} ✅\n"
+        "━━━━━━━━━━━━━━\n"
+        f"{labels['text_claim']} 45%\n"
+        f"{labels['research']} {labels['example_not_specified']}\n"
+        f"{labels['conclusion']} {labels['example_conclusion2']}\n"
+        f"{labels['status']} ⚠️\n"
+        "━━━━━━━━━━━━━━\n"
+        "(Continue for MAX 3-4 claims - each claim MUST be different!)\n\n"
+        f"{labels['result']}\n"
+        "[2-3 sentences ONLY]\n\n"
+        "|||SPLIT|||\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        "PART 2: DETAILED ANALYSIS (Complete)\n"
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        "CRITICAL: Add blank line between EVERY paragraph for readability!\n"
+        "DO NOT use bullet points (•) or asterisks (*)\n"
+        "Use simple numbered lists or plain paragraphs\n\n"
+        "For each claim:\n"
+        "- Full scientific explanation\n"
+        "- Exact references with titles and links\n"
+        "- Biological/technical mechanisms\n"
+        "- Detailed comparison of ALL claimed vs actual data\n"
+        "- Academic sources with DOI/URLs\n\n"
+        "Text to analyze:\n"
+    )
+
+# Fully assembled prompts, built once at import (other codes use the default)
+_PROMPT_BY_LANG = {code: _build_analysis_prompt(code) for code in ANALYSIS_LANG_MAP}
+_PROMPT_DEFAULT = _build_analysis_prompt(None)
+
+# Provider detection for chain responses: first matching hint wins.
+# DeepSeek (OpenAI-compatible) reports token_usage but never Gemini's safety_ratings.
+_PROVIDER_HINTS = (
+    ("deepseek-chat", lambda md: str(md.get("model_name", "")).startswith("deepseek")
+        or ("token_usage" in md and "safety_ratings" not in md)),
+    ("gemini-2.5-flash", lambda md: "safety_ratings" in md
+        or str(md.get("model_name", "")).startswith("gemini")),
+)
+
+def detect_model_name(response) -> str:
+    """Return the name of the model that actually answered a chain call"""
+    md = getattr(response, "response_metadata", None) or {}
+    reported = str(md.get("model_name") or "")
+    for default_name, matches in _PROVIDER_HINTS:
+        if matches(md):
+            # Prefer the exact reported name when it belongs to the same provider
+            provider = default_name.split("-", 1)[0]
+            return reported if reported.startswith(provider) else default_name
+    return reported or "gemini-2.5-flash"
+
+# Pending "analysis complete" edits, keyed by (chat_id, message_id)
+STATUS_EDIT_TASKS = {}
+
+async def _edit_status_quietly(status_msg, text):
+    """Best-effort Markdown status edit (errors are ignored)"""
+    try:
+        await status_msg.edit_text(text, parse_mode='Markdown')
+    except Exception:
+        pass
+
+async def _await_status_edit(status_msg):
+    """Wait for a pending status edit so later edits are not overwritten"""
+    task = STATUS_EDIT_TASKS.pop((status_msg.chat_id, status_msg.message_id), None)
+    if task:
+        await task
 
+async def _send_markdown(send, text, **kwargs):
+    """Send/edit with Markdown, falling back to plain text on parse errors"""
+    try:
+        return await tg_send(send, text, parse_mode='Markdown', **kwargs)
+    except Exception:
+        return await tg_send(send, text, parse_mode=None, **kwargs)
+
+# During an API outage every request fails the same way; keep one full
+# traceback per interval and log the rest as one-liners.
+TRACEBACK_LOG_INTERVAL = 60
+_last_traceback_ts = 0.0
+
+def traceback_due() -> bool:
+    """True at most once per TRACEBACK_LOG_INTERVAL seconds"""
+    global _last_traceback_ts
+    now = time.monotonic()
+    if now - _last_traceback_ts < TRACEBACK_LOG_INTERVAL:
+        return False
+    _last_traceback_ts = now
+    return True
+
+# ==============================================================================
+# AI ANSWER CACHE (exact prompt match, persisted in SQLite)
+# ==============================================================================
+# Identical prompts (same text + language) are answered from disk instead of
+# another multi-second LLM call. Keyed by SHA1 of the full prompt.
+AI_ANSWER_DB = get_storage_path("ai_cache.sqlite3")
+AI_ANSWER_TTL_SECONDS = 86400  # fact-checks age: keep answers for a day
+AI_ANSWER_PURGE_INTERVAL = 3600  # expired rows (user texts) are deleted hourly
+_AI_DB = {"conn": None}
+_AI_DB_LOCK = threading.Lock()  # one connection, used from worker threads
+
+def _ai_db() -> sqlite3.Connection:
+    conn = _AI_DB["conn"]
+    if conn is None:
+        conn = sqlite3.connect(AI_ANSWER_DB, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS ai_cache(hash TEXT PRIMARY KEY, response BLOB, ts INTEGER)")
+        _AI_DB["conn"] = conn
+    return conn
+
+def _ai_answer_get(key: str) -> Optional[tuple]:
+    with _AI_DB_LOCK:
+        row = _ai_db().execute("SELECT response, ts FROM ai_cache WHERE hash = ?", (key,)).fetchone()
+    if row is None or time.time() - row[1] > AI_ANSWER_TTL_SECONDS:
+        return None
+    data = parse_json(row[0])
+    return data["content"], data.get("model", "")
+
+def _ai_answer_put(key: str, content: str, model: str):
+    blob = json.dumps({"content": content, "model": model}, ensure_ascii=False).encode("utf-8")
+    with _AI_DB_LOCK:
+        conn = _ai_db()
+        conn.execute("INSERT OR REPLACE INTO ai_cache VALUES (?, ?, ?)", (key, blob, int(time.time())))
+        conn.commit()
+
+def purge_ai_answers():
+    """Drop expired answers (run off the event loop by purge_ai_answers_job)"""
+    with _AI_DB_LOCK:
+        conn = _ai_db()
+        conn.execute("DELETE FROM ai_cache WHERE ts < ?", (int(time.time() - AI_ANSWER_TTL_SECONDS),))
+        conn.commit()
+
+async def purge_ai_answers_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback: periodic purge of expired AI answers"""
+    try:
+        await asyncio.to_thread(purge_ai_answers)
+    except Exception as e:
+        logger.warning(f"⚠️ AI cache purge failed: {e}")
+
+async def lookup_ai_answer(prompt_text: str) -> Optional[tuple]:
+    """(content, model_name) cached for this exact prompt, or None"""
+    key = hashlib.sha1(prompt_text.encode()).hexdigest()
+    try:
+        return await asyncio.to_thread(_ai_answer_get, key)
+    except Exception as e:
+        logger.warning(f"⚠️ AI cache lookup failed: {e}")
+        return None
+
+async def store_ai_answer(prompt_text: str, content: str, model: str = ""):
+    """Remember a successful answer for this exact prompt"""
+    key = hashlib.sha1(prompt_text.encode()).hexdigest()
+    try:
+        await asyncio.to_thread(_ai_answer_put, key, content, model)
+    except Exception as e:
+        logger.warning(f"⚠️ AI cache store failed: {e}")
 
 async def analyze_text_gemini(text, status_msg=None, lang_code="fa", user_id=None):
     """Analyze text using Smart Chain Fallback"""
@@ -1033,159 +1899,65 @@ async def analyze_text_gemini(text, status_msg=None, lang_code="fa", user_id=Non
     # if not SETTINGS["fact_check"]: return None
 
 
-    # Map lang_code to English name for Prompt
-    lang_map = {"fa": "Persian (Farsi)", "en": "English", "fr": "French"}
-    target_lang = lang_map.get(lang_code, "Persian")
+    target_lang = ANALYSIS_LANG_MAP.get(lang_code, "Persian")
 
     try:
         logger.info(f"🧠 STARTING AI ANALYSIS ({target_lang}) for text: {text[:20]}...")
-        # Language-specific labels for comparison table
-        if lang_code == "fa":
-            overall_status_label = "**وضعیت کلی:**"
-            comparison_table_label = "**جدول مقایسه:**"
-            text_claim_label = "▫️ **ادعای متن:**"
-            research_label = "▫️ **مقالات:**"
-            conclusion_label = "▫️ **نتیجه تحقیقات:**"
-            status_label = "▫️ **وضعیت:**"
-            result_label = "**نتیجه:**"
-            example_conclusion1 = "تحقیقات این میزان خستگی را تأیید می‌کند"
-            example_conclusion2 = "تحقیقات کاهش تمرکز را نشان می‌دهد اما درصد دقیق متفاوت است"
-            example_not_specified = "در تحقیقات مشخص نشده"
-        elif lang_code == "en":
-            overall_status_label = "**Overall Status:**"
-            comparison_table_label = "**Comparison Table:**"
-            text_claim_label = "▫️ **Text Claim:**"
-            research_label = "▫️ **Research Papers:**"
-            conclusion_label = "▫️ **Research Findings:**"
-            status_label = "▫️ **Status:**"
-            result_label = "**Conclusion:**"
-            example_conclusion1 = "Research confirms fatigue increases by this amount"
-            example_conclusion2 = "Research shows concentration decreases but exact percentage varies"
-            example_not_specified = "Not specified in research"
-        else:  # French
-            overall_status_label = "**Statut Global:**"
-            comparison_table_label = "**Tableau de Comparaison:**"
-            text_claim_label = "▫️ **Affirmation du Texte:**"
-            research_label = "▫️ **Articles:**"
-            conclusion_label = "▫️ **Résultats de Recherche:**"
-            status_label = "▫️ **Statut:**"
-            result_label = "**Conclusion:**"
-            example_conclusion1 = "La recherche confirme cette augmentation de fatigue"
-            example_conclusion2 = "La recherche montre une diminution de concentration mais le pourcentage exact varie"
-            example_not_specified = "Non spécifié dans la recherche"
-        
+        prompt_text = _PROMPT_BY_LANG.get(lang_code, _PROMPT_DEFAULT) + text
 
-        prompt_text = (
-            f"You are a professional Fact-Check Assistant. Analyze the following text and provide your response STRICTLY in **{target_lang}**.\n\n"
-
-            "🛑 STRICT RELEVANCE FILTER (CRITICAL):\n"
-            "You must internalize these 3 rules to decide if you need to output '|||IRRELEVANT|||':\n\n"
-            "#### 1. REJECTION CRITERIA (Mark as IRRELEVANT)\n"
-            "Reject the input if it falls into any of these categories:\n"
-            "* **Political Commentary & News Analysis:** Debates, opinions on government policies, or praising/criticizing politicians (e.g., 'Policy X is a failure').\n"
-            "* **Social & Cultural Criticism:** Rants or general statements about society and human behavior (e.g., 'People are lazier these days').\n"
-            "* **Personal Opinions & Beliefs:** Subjective claims, personal defenses, or 'I think/believe' statements.\n"
-            "* **Conversational Fillers:** Jokes, sarcasm, greetings, or rhetorical questions that do not seek a factual answer.\n"
-            "* **General/Philosophical Statements:** Abstract or existential claims (e.g., 'Life is a journey').\n\n"
-            "#### 2. ACCEPTANCE CRITERIA\n"
-            "Accept the input **ONLY** if it meets the following condition:\n"
-            "* The text makes a **specific, objective, and verifiable claim** regarding **Science, Medicine, History, or Statistics**.\n\n"
-            "#### 3. CORE RULES\n"
-            "* **Dominant Intent:** If the text is primarily political or social commentary, **REJECT IT** even if it contains minor factual references.\n"
-            "* **Threshold of Doubt:** If you are unsure whether a claim is verifiable or if it is just a debate topic, **REJECT IT as IRRELEVANT**.\n"
-            "* **Final Action:** Only proceed to fact-check if there is a concrete claim about reality that can be proven or disproven by evidence.\n\n"
-            "Output ONLY '|||IRRELEVANT|||' if rejection criteria are met.\n"
-            "|||IRRELEVANT|||\n\n"
-            "CRITICAL FORMATTING RULES:\n"
-            "1. Your response MUST be split into TWO parts using: |||SPLIT|||\n"
-            "2. Use ✅ emoji ONLY for TRUE/VERIFIED claims\n"
-            "3. Use ❌ emoji ONLY for FALSE/INCORRECT claims\n"
-            "4. Use ⚠️ emoji for PARTIALLY TRUE/MISLEADING claims\n"
-            "5. DO NOT use bullet points (•) or asterisks (*) - Telegram doesn't support them well\n"
-            "6. Add blank lines between paragraphs for readability\n\n"
-            "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            "PART 1: SUMMARY (VERY SHORT - Mobile Display)\n"
-            "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            "IMPORTANT: Keep this section VERY SHORT (max 500 words)\n"
-            "RULE: If the text contains only ONE simple claim, analyze ONLY that claim. DO NOT invent 'implied' claims unless they are dangerous or misleading.\n"
-            f"Format EXACTLY like this:\n\n"
-            f"{overall_status_label} [✅/⚠️/❌]\n\n"
-            f"{comparison_table_label}\n"
-            "━━━━━━━━━━━━━━\n"
-            f"{text_claim_label} 17%\n"
-            f"{research_label} 17.1%\n"
-            f"{conclusion_label} {example_conclusion1}\n"
-            f"{status_label} ✅\n"
-            "━━━━━━━━━━━━━━\n"
-            f"{text_claim_label} 45%\n"
-            f"{research_label} {example_not_specified}\n"
-            f"{conclusion_label} {example_conclusion2}\n"
-            f"{status_label} ⚠️\n"
-            "━━━━━━━━━━━━━━\n"
-            "(Continue for MAX 3-4 claims - each claim MUST be different!)\n\n"
-            f"{result_label}\n"
-            "[2-3 sentences ONLY]\n\n"
-            "|||SPLIT|||\n\n"
-            "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            "PART 2: DETAILED ANALYSIS (Complete)\n"
-            "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            "CRITICAL: Add blank line between EVERY paragraph for readability!\n"
-            "DO NOT use bullet points (•) or asterisks (*)\n"
-            "Use simple numbered lists or plain paragraphs\n\n"
-            "For each claim:\n"
-            "- Full scientific explanation\n"
-            "- Exact references with titles and links\n"
-            "- Biological/technical mechanisms\n"
-            "- Detailed comparison of ALL claimed vs actual data\n"
-            "- Academic sources with DOI/URLs\n\n"
-            f"Text to analyze:\n{text}"
-        )
-        
-        chain = get_smart_chain()
-        logger.info(f"🚀 Invoking LangChain with 8-Layer Defense for user {user_id}...")
-        
-        # Add callback for live model name updates
-        config = {}
-        if status_msg:
-            config["callbacks"] = [StatusUpdateCallback(status_msg, get_msg)]
-        
-        # Invoke Chain (Async) with callbacks
-        try:
-            # Add error logging callback (Ensure correct instantiation)
-            run_config = config.copy() if config else {}
-            run_config["callbacks"] = run_config.get("callbacks", []) + [FallbackErrorCallback()]
-            
-            response = await chain.ainvoke([HumanMessage(content=prompt_text)], config=run_config)
-
-        except Exception as chain_error:
-            logger.error(f"🚨 CRITICAL CHAIN FAILURE: Type={type(chain_error).__name__} | Msg={chain_error}")
-            # Log the full traceback for deep debugging
-            import traceback
-            logger.error(traceback.format_exc())
-            raise # Re-raise to be caught by the outer block which sends 'price_error'
+        cached = await lookup_ai_answer(prompt_text)
+        if cached:
+            logger.info(f"♻️ Serving cached analysis for user {user_id}")
+            response = AIMessage(content=cached[0], response_metadata={"model_name": cached[1]})
+        else:
+            chain = get_smart_chain()
+            logger.info(f"🚀 Invoking LangChain with 8-Layer Defense for user {user_id}...")
+
+            # Add callback for live model name updates
+            config = {}
+            if status_msg:
+                config["callbacks"] = [StatusUpdateCallback(status_msg, get_msg)]
+
+            # Invoke Chain (Async) with callbacks
+            try:
+                # Add error logging callback (Ensure correct instantiation)
+                run_config = config.copy() if config else {}
+                run_config["callbacks"] = run_config.get("callbacks", []) + [FallbackErrorCallback()]
+
+                async with AI_SEM:
+                    response = await chain.ainvoke([HumanMessage(content=prompt_text)], config=run_config)
+
+            except Exception as chain_error:
+                # Full traceback for deep debugging, throttled during error storms
+                logger.error(
+                    f"🚨 CRITICAL CHAIN FAILURE: Type={type(chain_error).__name__} | Msg={chain_error}",
+                    exc_info=traceback_due()
+                )
+                raise # Re-raise to be caught by the outer block which sends 'price_error'
+
+            content = extract_text(response)
+            if content:
+                await store_ai_answer(prompt_text, content, detect_model_name(response))
         
         # Final status update with actual model name
         if status_msg:
-            model_raw = response.response_metadata.get('model_name', 'gemini-2.5-flash')
-            if "token_usage" in response.response_metadata:
-                model_raw = "deepseek-chat"
-            
-            # Use model_raw directly (exact model name like "gemini-2.5-flash")
-            model_name = model_raw
+            # Use the exact model name (like "gemini-2.5-flash")
+            model_name = detect_model_name(response)
             
-            try:
-                await status_msg.edit_text(
-                    get_msg("analysis_complete", user_id).format(model=model_name),
-                    parse_mode='Markdown'
+            # Fire the status edit without waiting for its round-trip;
+            # smart_reply awaits it before overwriting the same message.
+            STATUS_EDIT_TASKS[(status_msg.chat_id, status_msg.message_id)] = asyncio.create_task(
+                _edit_status_quietly(
+                    status_msg,
+                    format_msg("analysis_complete", user_id, model=model_name)
                 )
-            except Exception:
-                pass
+            )
         
         logger.info(f"✅ Response from {model_name}")
         return response
 
     except Exception as e:
-        logger.error(f"❌ SmartChain Error: {e}", exc_info=True)
+        logger.error("❌ SmartChain Error: %s", e, exc_info=traceback_due())
         return None
 
 # 4. Localization Dictionary
@@ -1336,6 +2108,7 @@ MESSAGES = {
         "learn_word_not_found": "❌ کلمه **{word}** پیدا نشد.\nآیا منظورتان **{suggestion}** بود؟\n(منبع: {lang} - {dict})",
         "learn_word_not_found_no_suggestion": "❌ کلمه **{word}** در هیچ دیکشنری معتبری پیدا نشد. لطفاً املای آن را بررسی کنید.",
         "learn_error": "❌ خطایی در فرآیند آموزش رخ داد.",
+        "task_error": "❌ خطایی در پردازش درخواست شما رخ داد. لطفاً دوباره تلاش کنید.",
         "learn_fallback_meaning": "ترجمه مستقیم",
         "learn_fallback_translation": "ترجمه جمله نمونه",
         "status_label_user": "کاربر",
@@ -1494,6 +2267,7 @@ MESSAGES = {
         "learn_word_not_found": "❌ **{word}** not found.\nDid you mean **{suggestion}**?\n(Source: {lang} - {dict})",
         "learn_word_not_found_no_suggestion": "❌ Word '**{word}**' was not found in any reliable dictionary. Please check your spelling.",
         "learn_error": "❌ An error occurred during the educational process.",
+        "task_error": "❌ Something went wrong while processing your request. Please try again.",
         "learn_fallback_meaning": "Direct translation",
         "learn_fallback_translation": "Example sentence translation",
         "status_label_user": "User",
@@ -1654,6 +2428,7 @@ MESSAGES = {
         "learn_word_not_found": "⚠️ Mot '**{word}**' introuvable. Affichage des résultats pour '**{suggestion}**' trouvé en {lang} ({dict}) à la place...",
         "learn_word_not_found_no_suggestion": "❌ Le mot '**{word}**' n'a été trouvé dans aucun dictionnaire fiable. Veuillez vérifier l'orthographe.",
         "learn_error": "❌ Une erreur est survenue pendant le processus éducatif.",
+        "task_error": "❌ Une erreur est survenue lors du traitement de votre demande. Veuillez réessayer.",
         "learn_fallback_meaning": "Traduction directe",
         "learn_fallback_translation": "Traduction de la phrase d'exemple",
         "status_label_user": "Utilisateur",
@@ -1811,6 +2586,7 @@ MESSAGES = {
         "learn_word_not_found": "❌ **{word}** 을(를) 찾을 수 없습니다.\n혹시 **{suggestion}** 을(를) 찾으시나요?\n(출처: {lang} - {dict})",
         "learn_word_not_found_no_suggestion": "❌ **{word}** 단어를 신뢰할 수 있는 사전에서 찾을 수 없습니다. 철자를 확인해 주세요.",
         "learn_error": "❌ 교육 과정 중 오류가 발생했습니다.",
+        "task_error": "❌ 요청을 처리하는 중 오류가 발생했습니다. 다시 시도해 주세요.",
         "learn_fallback_meaning": "직역",
         "learn_fallback_translation": "예문 번역",
         "status_label_user": "사용자",
@@ -1846,35 +2622,60 @@ MESSAGES = {
     }
 }
 
+# Direct references for the common lookups in get_msg
+_MSG_FA = MESSAGES["fa"]
+_MSG_EN = MESSAGES["en"]
+
+# Flat (lang, key) -> text table with the fallback chain pre-merged:
+# user lang -> English -> Persian -> "" (MESSAGES is static)
+_ALL_MSG_KEYS = set().union(*(m.keys() for m in MESSAGES.values()))
+FLAT_MSG = {
+    (lang, key): msgs.get(key, _MSG_EN.get(key, _MSG_FA.get(key, "")))
+    for lang, msgs in MESSAGES.items()
+    for key in _ALL_MSG_KEYS
+}
+
+def _lookup_msg(key, lang):
+    """Resolve (key, lang) in FLAT_MSG; unknown languages fall back to fa"""
+    text = FLAT_MSG.get((lang, key))
+    if text is None:
+        text = FLAT_MSG.get(("fa", key), "")
+    return text
+
+def get_user_lang(user_id=None):
+    """User's language (first interaction initializes the default), or the global one"""
+    if user_id:
+        return USER_LANG.setdefault(user_id, "fa")
+    return SETTINGS.get("lang", "fa")
+
 def get_msg(key, user_id=None):
     """Retrieve localized message based on User ID or Global Settings"""
-    # 1. Determine user's current language
-    lang = "fa"
-    if user_id:
-        if user_id in USER_LANG:
-            lang = USER_LANG[user_id]
-        else:
-            # First interaction via command? Initialize default
-            USER_LANG[user_id] = "fa"
-            lang = "fa"
-    else:
-        lang = SETTINGS.get("lang", "fa")
-    
-    # 2. Validation & Fallback Logic
-    if lang not in MESSAGES: 
-        lang = "fa"
-    
-    # Priority: User Lang Key -> English Key -> Farsi Key -> Empty String
-    target_dict = MESSAGES.get(lang, MESSAGES["fa"])
-    if key in target_dict:
-        return target_dict[key]
-    
-    # Fallback to English if key missing in target lang
-    if key in MESSAGES["en"]:
-        return MESSAGES["en"][key]
-        
-    # Fallback to Farsi as ultimate default
-    return MESSAGES["fa"].get(key, "")
+    return _lookup_msg(key, get_user_lang(user_id))
+
+@functools.lru_cache(maxsize=2048)
+def _format_msg_cached(lang, key, fields):
+    return _lookup_msg(key, lang).format(**dict(fields))
+
+def format_msg(key, user_id=None, **fields):
+    """get_msg(...).format(...) memoized per (lang, key, fields); only for low-cardinality fields"""
+    return _format_msg_cached(get_user_lang(user_id), key, tuple(sorted(fields.items())))
+
+# Pre-rendered status headers: lang -> {(download, fact_check): text}
+STATUS_TABLE = {
+    lang: {
+        (dl, fc): _lookup_msg("status_fmt", lang).format(
+            dl=_lookup_msg("dl_on" if dl else "dl_off", lang),
+            fc=_lookup_msg("fc_on" if fc else "fc_off", lang),
+        )
+        for dl in (True, False) for fc in (True, False)
+    }
+    for lang in MESSAGES
+}
+
+def render_status_info(user_id=None) -> str:
+    """Localized status header for the current download/fact-check toggles"""
+    table = STATUS_TABLE.get(get_user_lang(user_id), STATUS_TABLE["fa"])
+    return table[(bool(SETTINGS["download"]), bool(SETTINGS["fact_check"]))]
 
 # ==============================================================================
 # HELPERS: CLEANUP & ERROR REPORTING
@@ -1921,6 +2722,13 @@ async def schedule_countdown_delete(context, chat_id: int, message_id: int, user
     except Exception:
         pass
 
+# First http(s) URL in a message
+_URL_RE = re.compile(r'(https?://\S+)')
+
+def is_group_chat(msg) -> bool:
+    """True for any non-private chat (group, supergroup, channel), read from the chat type"""
+    return msg.chat.type != constants.ChatType.PRIVATE
+
 async def safe_delete(message):
     """Safely delete a message without crashing on BadRequest"""
     if not message: return
@@ -1972,8 +2780,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.error("❌ Exception while handling an update:", exc_info=context.error)
 
     # Optional: Notify Admin
-    admin_id = SETTINGS.get("admin_id")
-    if admin_id:
+    if ADMIN_ID:
         try:
             tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
             tb_string = "".join(tb_list)
@@ -1988,7 +2795,7 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
                 f"Error: `{context.error}`\n\n"
                 f"Traceback:\n```python\n{tb_string}\n```"
             )
-            await context.bot.send_message(chat_id=admin_id, text=message, parse_mode='Markdown')
+            await context.bot.send_message(chat_id=ADMIN_ID, text=message, parse_mode='Markdown')
         except Exception as e:
             logger.error(f"Failed to send error report to admin: {e}")
 
@@ -2004,7 +2811,7 @@ async def reply_with_countdown(update: Update, context, text: str, delay: int =
     reply_msg = await msg.reply_text(text, **kwargs)
     
     # Only countdown in groups
-    if msg.chat_id < 0:
+    if is_group_chat(msg):
         asyncio.create_task(
             schedule_countdown_delete(
                 context=context,
@@ -2033,8 +2840,8 @@ async def reply_and_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, t
         logger.info(f"🧪 [DEV] Skipping auto-deletion for msg at {reply_msg.message_id}")
         return reply_msg
 
-    # Only auto-delete in groups (negative chat_id)
-    if msg.chat_id < 0:
+    # Only auto-delete in groups
+    if is_group_chat(msg):
         # Delete Bot's Reply
         context.job_queue.run_once(
             delete_scheduled_message,
@@ -2053,8 +2860,7 @@ async def report_error_to_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int
     """
     Silently reports an error to the admin instead of spamming the group.
     """
-    admin_id = SETTINGS["admin_id"]
-    if not admin_id: return
+    if not ADMIN_ID: return
 
     try:
         report = (
@@ -2063,7 +2869,7 @@ async def report_error_to_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int
             f"💻 Command: `{command}`\n"
             f"⚠️ Error: `{error_msg}`"
         )
-        await context.bot.send_message(chat_id=admin_id, text=report, parse_mode='Markdown')
+        await context.bot.send_message(chat_id=ADMIN_ID, text=report, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Failed to send error report to admin: {e}")
 
@@ -2071,25 +2877,23 @@ async def report_error_to_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int
 # LOGIC: MENU & KEYBOARDS
 # ==============================================================================
 
-def get_main_keyboard(user_id):
+def _build_main_keyboard(lang, is_admin):
     """Generate a compact 3-row keyboard for all user types"""
-    is_admin = user_id == SETTINGS["admin_id"]
-    
     # Row 1: Core Features (Status, Help, Price)
     row1 = [
-        KeyboardButton(get_msg("btn_status", user_id)),
-        KeyboardButton(get_msg("btn_help", user_id)),
-        KeyboardButton(get_msg("btn_price", user_id))
+        KeyboardButton(_lookup_msg("btn_status", lang)),
+        KeyboardButton(_lookup_msg("btn_help", lang)),
+        KeyboardButton(_lookup_msg("btn_price", lang))
     ]
     
     # Row 2: Dynamic row (Voice + Admin)
-    row2 = [KeyboardButton(get_msg("btn_voice", user_id))]
+    row2 = [KeyboardButton(_lookup_msg("btn_voice", lang))]
     if is_admin:
         # For admin, we mix Voice with the most critical toggle
-        row2.append(KeyboardButton(get_msg("btn_dl", user_id)))
-        row2.append(KeyboardButton(get_msg("btn_fc", user_id)))
+        row2.append(KeyboardButton(_lookup_msg("btn_dl", lang)))
+        row2.append(KeyboardButton(_lookup_msg("btn_fc", lang)))
         # Note: 'Stop Bot' is moved to row2 for admin to stay within 3 rows
-        row2.append(KeyboardButton(get_msg("btn_stop", user_id)))
+        row2.append(KeyboardButton(_lookup_msg("btn_stop", lang)))
     
     # Row 3: Languages (Always at bottom)
     row3 = [
@@ -2102,6 +2906,18 @@ def get_main_keyboard(user_id):
     kb = [row1, row2, row3]
     return ReplyKeyboardMarkup(kb, resize_keyboard=True)
 
+# Keyboards are immutable per (language, admin) pair: build them once
+_KB_CACHE = {
+    (lang, is_admin): _build_main_keyboard(lang, is_admin)
+    for lang in MESSAGES for is_admin in (True, False)
+}
+
+def get_main_keyboard(user_id):
+    """Cached main keyboard for the user's language and role"""
+    lang = get_user_lang(user_id)
+    is_admin = user_id == ADMIN_ID
+    return _KB_CACHE.get((lang, is_admin)) or _KB_CACHE[("fa", is_admin)]
+
 async def send_welcome(update: Update):
     """Send welcome message with menu"""
     user = update.effective_user
@@ -2140,6 +2956,7 @@ async def fetch_market_data():
             resp = await client.get(url, headers=headers)
             resp.raise_for_status()
             
+        from bs4 import BeautifulSoup  # only the /price path needs it
         soup = BeautifulSoup(resp.text, 'html.parser')
         
         # Scrape data using verified selectors with fallbacks
@@ -2221,7 +3038,7 @@ async def cmd_price_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await status_msg.edit_text(price_text, parse_mode='Markdown')
     
     # Auto-delete with countdown in groups
-    if msg.chat_id < 0:  # Group chat
+    if is_group_chat(msg):
         asyncio.create_task(
             schedule_countdown_delete(
                 context=context,
@@ -2238,34 +3055,45 @@ async def cmd_price_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # HELPERS
 # ==============================================================================
 
-async def smart_reply(msg, status_msg, response, user_id, lang="fa"):
-    """Send AI response with formatted model name and /detail instruction"""
+def quota_footer(user_id, remaining) -> str:
+    """Remaining-requests line appended to AI replies (empty for admin)"""
+    if user_id == ADMIN_ID:
+        return ""
+    return "\n\n" + format_msg("remaining_requests", user_id, remaining=remaining)
+
+# Display names for the raw model ids reported by the chain
+_MODEL_MAP = {
+    "gemini-2.5-pro": "Gemini 2.5 Pro",
+    "gemini-1.5-pro": "Gemini 1.5 Pro",
+    "gemini-2.5-flash": "Gemini 2.5 Flash",
+    "gemini-2.0-flash": "Gemini 2.0 Flash",
+    "gemini-1.5-flash": "Gemini 1.5 Flash",
+    "gemini-1.5-flash-8b": "Gemini 1.5 Flash 8B",
+    "deepseek-chat": "DeepSeek Chat"
+}
+
+# Cached in place of /detail when the response has no |||SPLIT||| part
+_NO_DETAIL_MSGS = {
+    "fa": "⚠️ جزئیات بیشتری در دسترس نیست",
+    "en": "⚠️ No additional details available",
+    "fr": "⚠️ Aucun détail supplémentaire"
+}
+
+async def smart_reply(msg, status_msg, response, user_id, lang="fa", footer=""):
+    """Send AI response with formatted model name and /detail instruction.
+    `footer` (e.g. the quota line) is appended to the last message."""
     if not response:
-        await status_msg.edit_text(get_msg("err_api", user_id))
+        await _await_status_edit(status_msg)
+        await status_msg.edit_text(get_msg("err_api", user_id) + footer)
         return
 
     # 1. Format Model Name
-    model_raw = response.response_metadata.get("model_name", "gemini-2.5-flash")
-    if "token_usage" in response.response_metadata:
-        model_raw = "deepseek-chat"
-    
-    model_map = {
-        "gemini-2.5-pro": "Gemini 2.5 Pro",
-        "gemini-1.5-pro": "Gemini 1.5 Pro",
-        "gemini-2.5-flash": "Gemini 2.5 Flash",
-        "gemini-2.0-flash": "Gemini 2.0 Flash",
-        "gemini-1.5-flash": "Gemini 1.5 Flash",
-        "gemini-1.5-flash-8b": "Gemini 1.5 Flash 8B",
-        "deepseek-chat": "DeepSeek Chat"
-    }
-    model_name = model_map.get(model_raw, model_raw.replace("-", " ").title())
+    model_raw = detect_model_name(response)
+    model_name = _MODEL_MAP.get(model_raw) or model_raw.replace("-", " ").title()
     
     # 2. Get Headers and Footers from Dictionary
-    header = get_msg("analysis_header", user_id).format(model=model_name)
-    footer = get_msg("analysis_footer_note", user_id)
-    
-    # 3. Parse Split (Summary vs Detail)
-    full_content = extract_text(response)
+    header = format_msg("analysis_header", user_id, model=model_name)
+    footer_note = get_msg("analysis_footer_note", user_id)
     
     # 3. Parse Split (Summary vs Detail)
     full_content = extract_text(response)
@@ -2274,65 +3102,74 @@ async def smart_reply(msg, status_msg, response, user_id, lang="fa"):
     if "|||IRRELEVANT|||" in full_content:
         # Fallback to localized "Stop fooling around" message
         refusal_msg = get_msg("irrelevant_msg", user_id)
-        await status_msg.edit_text(refusal_msg)
+        await _await_status_edit(status_msg)
+        await status_msg.edit_text(refusal_msg + footer)
         return
 
-    split_marker = "|||SPLIT|||"
+    summary_part, split_marker, detail_part = full_content.partition("|||SPLIT|||")
     
-    if split_marker in full_content:
-        parts = full_content.split(split_marker, 1)
-        summary_text = parts[0].strip()
-        detail_text = parts[1].strip()
+    if split_marker:
+        summary_text = summary_part.strip()
+        detail_text = detail_part.strip()
         
         # Cache detailed analysis
-        LAST_ANALYSIS_CACHE[user_id] = f"{header}\n\n{detail_text}"
+        set_last_analysis(user_id, f"{header}\n\n{detail_text}")
         logger.info(f"💾 Cached {len(detail_text)} chars for user {user_id}")
     else:
         # No split found - send everything as summary
         logger.warning(f"⚠️ No split marker found in response")
         summary_text = full_content
-        
-        no_detail_msgs = {
-            "fa": "⚠️ جزئیات بیشتری در دسترس نیست",
-            "en": "⚠️ No additional details available",
-            "fr": "⚠️ Aucun détail supplémentaire"
-        }
-        LAST_ANALYSIS_CACHE[user_id] = no_detail_msgs.get(lang, no_detail_msgs["fa"])
+        set_last_analysis(user_id, _NO_DETAIL_MSGS.get(lang, _NO_DETAIL_MSGS["fa"]))
 
     # 4. Construct final message
-    final_text = f"{header}\n\n{summary_text}{footer}"
+    final_text = f"{header}\n\n{summary_text}{footer_note}{footer}"
     
+    # Parsing is done; make sure the "analysis complete" edit has landed
+    await _await_status_edit(status_msg)
+
     # 5. Send (with chunking if needed)
     max_length = 4000
     if len(final_text) > max_length:
         # Chunk the message
-        chunks = [final_text[i:i+max_length] for i in range(0, len(final_text), max_length)]
-        for i, chunk in enumerate(chunks):
-            try:
-                if i == 0:
-                    await status_msg.edit_text(chunk, parse_mode='Markdown')
-                else:
-                    await msg.reply_text(chunk, parse_mode='Markdown')
-            except Exception:
-                # Fallback without Markdown
-                if i == 0:
-                    await status_msg.edit_text(chunk, parse_mode=None)
-                else:
-                    await msg.reply_text(chunk, parse_mode=None)
+        # Each chunk is balanced on its own so a bold/italic span cut across
+        # chunks doesn't push the send onto the plain-text fallback
+        chunks = [_balance_markdown(c) for c in _chunk_markdown(final_text, max_length)]
+
+        async def send_rest():
+            # Replies stay sequential to preserve chat order
+            for chunk in chunks[1:]:
+                await _send_markdown(msg.reply_text, chunk)
+
+        # Editing the existing status message can't reorder the chat,
+        # so it overlaps with the follow-up replies.
+        await asyncio.gather(
+            _send_markdown(status_msg.edit_text, chunks[0]),
+            send_rest()
+        )
     else:
-        # Normal case
-        try:
-            logger.info(f"📤 [User {user_id}] Sending final {len(final_text)} chars response...")
-            await status_msg.edit_text(final_text, parse_mode='Markdown')
-            logger.info(f"✅ [User {user_id}] Response sent successfully.")
-        except Exception as e:
-            logger.warning(f"⚠️ [User {user_id}] Markdown send failed, falling back to plain text: {e}")
-            await status_msg.edit_text(final_text, parse_mode=None)
+        # Normal case: pre-balanced, so the plain-text resend in
+        # _send_markdown is only a safety net
+        logger.info(f"📤 [User {user_id}] Sending final {len(final_text)} chars response...")
+        await _send_markdown(status_msg.edit_text, _balance_markdown(final_text))
+        logger.info(f"✅ [User {user_id}] Response sent successfully.")
 
 # ==============================================================================
 # LOGIC: INSTAGRAM DOWNLOAD (YT-DLP + COBALT FALLBACK)
 # ==============================================================================
 
+def reserve_temp_path(prefix: str, suffix: str) -> Path:
+    """Unique path in TEMP_DIR. The placeholder file is removed again so
+    yt-dlp doesn't treat the target as already downloaded."""
+    with tempfile.NamedTemporaryFile(prefix=prefix, suffix=suffix, dir=TEMP_DIR, delete=False) as tmp:
+        path = Path(tmp.name)
+    path.unlink()
+    return path
+
+async def read_file_async(path: Path) -> bytes:
+    """Read a whole file via aiofiles so uploads don't block the event loop"""
+    async with aiofiles.open(path, "rb") as f:
+        return await f.read()
+
 async def download_instagram_cobalt(url: str, filename: Path) -> bool:
     """Download video using Cobalt API as fallback"""
     logger.info("🛡️ Falling back to Cobalt API...")
@@ -2556,10 +3393,11 @@ async def compress_video(input_path: Path) -> bool:
         ]
     
     try:
+        # Only stderr is inspected (on failure); don't buffer stdout
         process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
         )
-        stdout, stderr = await process.communicate()
+        _, stderr = await process.communicate()
         
         if process.returncode == 0 and output_path.exists():
             final_size = output_path.stat().st_size / (1024*1024)
@@ -2571,11 +3409,11 @@ async def compress_video(input_path: Path) -> bool:
             return True
         else:
             logger.error(f"❌ ffmpeg failed: {stderr.decode()[:200]}")
-            if output_path.exists(): output_path.unlink()
+            output_path.unlink(missing_ok=True)
             return False
     except Exception as e:
         logger.error(f"💥 ffmpeg Exception: {e}")
-        if output_path.exists(): output_path.unlink()
+        output_path.unlink(missing_ok=True)
         return False
 
         if output_path.exists(): output_path.unlink()
@@ -2595,9 +3433,9 @@ async def generate_thumbnail(video_path: Path) -> Optional[Path]:
             str(thumb_path)
         ]
         process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
         )
-        await process.communicate()
+        await process.wait()
         
         if thumb_path.exists():
             return thumb_path
@@ -2606,8 +3444,69 @@ async def generate_thumbnail(video_path: Path) -> Optional[Path]:
         logger.error(f"Thumbnail generation failed: {e}")
         return None
 
+def _resolve_yt_dlp_bin() -> str:
+    """Absolute yt-dlp path: venv first, then PATH (bare name as last resort)"""
+    venv_candidate = Path(sys.executable).parent / "yt-dlp"
+    if venv_candidate.exists():
+        return str(venv_candidate)
+    return shutil.which("yt-dlp") or "yt-dlp"
+
+YTDLP_BIN = _resolve_yt_dlp_bin()
+
+# Appended to a yt-dlp command line to get the caption back without an .info.json
+YTDLP_CAPTION_ARGS = ["--print", "after_move:%(description,title|)j"]
+
+async def run_yt_dlp(cmd: list) -> tuple:
+    """Run a yt-dlp command line, in-process when the yt_dlp package is importable.
+
+    `cmd[0]` is the executable (only used by the subprocess fallback).
+    Returns (returncode, error_text, caption); caption is "" unless the
+    command includes YTDLP_CAPTION_ARGS.
+    """
+    want_caption = "--print" in cmd
+    try:
+        import yt_dlp
+    except ImportError:
+        # No sensitive fds to protect; skipping the close sweep speeds up spawn.
+        # --print implies --quiet, so stdout only carries the caption line
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=subprocess.PIPE if want_caption else subprocess.DEVNULL,
+            stderr=subprocess.PIPE, close_fds=False
+        )
+        stdout, stderr = await process.communicate()
+        caption = ""
+        if want_caption and stdout:
+            try:
+                caption = json.loads(stdout.decode(errors="replace").strip().splitlines()[-1]) or ""
+            except (ValueError, IndexError):
+                pass
+        return process.returncode, stderr.decode(errors="replace"), caption
+
+    def _download():
+        # Same CLI flags, translated to YoutubeDL params by yt-dlp itself;
+        # the caption comes straight from the returned info dict
+        parsed = yt_dlp.parse_options(cmd[1:])
+        opts = {**parsed.ydl_opts, "quiet": True, "noprogress": True}
+        opts.pop("forceprint", None)
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            if not want_caption:
+                return ydl.download(parsed.urls), ""
+            info = ydl.extract_info(parsed.urls[0], download=True) or {}
+            return 0, info.get("description") or info.get("title") or ""
+
+    try:
+        returncode, caption = await asyncio.to_thread(_download)
+        return returncode, "", caption
+    except (Exception, SystemExit) as e:  # DownloadError, or bad CLI flags
+        return 1, str(e), ""
+
 async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom_caption_header=None, max_height: int = 480):
-    """Download and send video via yt-dlp. max_height controls quality ceiling (default 480p)."""
+    """Download and send video via yt-dlp (bounded by DL_SEM). max_height controls quality ceiling (default 480p)."""
+    async with DL_SEM:
+        return await _download_instagram(url, chat_id, bot, reply_to_message_id, custom_caption_header, max_height)
+
+async def _download_instagram(url, chat_id, bot, reply_to_message_id=None, custom_caption_header=None, max_height: int = 480):
     logger.info(f"🚀 [Chat {chat_id}] Downloading (max {max_height}p): {url}")
     
     # Clean URL: only strip query params for Instagram (YouTube needs ?v=)
@@ -2615,17 +3514,17 @@ async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom
         original_url = url
         url = url.split("?")[0]
         logger.info(f"🧹 Instagram URL cleaned: '{original_url}' -> '{url}'")
+
+    # 1. Filename setup (unique per download, safe for concurrent users)
+    filename = reserve_temp_path("insta_", ".mp4")
+    thumb_path = None
+    original_caption = ""
+    logger.debug(f"📂 Temp file initialized: {filename}")
     try:
-        # 1. Filename setup
-        timestamp = int(asyncio.get_event_loop().time())
-        filename = Path(f"insta_{timestamp}.mp4")
-        info_file = Path(f"insta_{timestamp}.info.json")
-        logger.debug(f"📂 Temp files initialized: {filename}, {info_file}")
         
-        # 2. Command - use absolute path if in venv
+        # 2. Command - absolute path resolved once at import
         venv_bin = Path(sys.executable).parent
-        yt_dlp_path = venv_bin / "yt-dlp"
-        executable = str(yt_dlp_path) if yt_dlp_path.exists() else "yt-dlp"
+        executable = YTDLP_BIN
         logger.info(f"🛠️ Using yt-dlp executable: {executable}")
 
         # Locate ffmpeg for merge operations
@@ -2679,7 +3578,8 @@ async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom
             *js_runtime_args,
             *ffmpeg_args,
             "-o", str(filename),
-            "--write-info-json",
+            *YTDLP_CAPTION_ARGS,
+            "--no-progress",
             "--no-playlist",
             url
         ]
@@ -2692,31 +3592,22 @@ async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom
 
         # 4. Run Download (1st Attempt: Anonymous)
         logger.info(f"📥 Attempt 1: Downloading {url} anonymously...")
-        process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
+        returncode, err_msg, original_caption = await run_yt_dlp(cmd)
         
         # Treatment: Successful download MUST produce a file. 
         # If exit code 0 but no file, consider it a failure.
-        if process.returncode != 0 or not filename.exists():
-            err_msg = stderr.decode()
-            out_msg = stdout.decode()
-            logger.warning(f"⚠️ Attempt 1 failed (Code {process.returncode}, File: {filename.exists()})")
+        if returncode != 0 or not filename.exists():
+            logger.warning(f"⚠️ Attempt 1 failed (Code {returncode}, File: {filename.exists()})")
             logger.error(f"yt-dlp stderr: {err_msg[:500]}")
-            if out_msg: logger.debug(f"yt-dlp stdout: {out_msg[:300]}")
 
             # 4.5 Attempt 2: With Browser Cookies (Safari)
             logger.info("📥 Attempt 2: Retrying with Safari cookies...")
             cmd_with_cookies = cmd[:-1] + ["--cookies-from-browser", "safari", url]
-            process = await asyncio.create_subprocess_exec(
-                *cmd_with_cookies, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
+            returncode, err_msg, original_caption = await run_yt_dlp(cmd_with_cookies)
             
-            if process.returncode != 0 or not filename.exists():
-                logger.warning(f"❌ Attempt 2 (Cookies) failed (Code {process.returncode}, File: {filename.exists()})")
-                logger.error(f"Full stderr from Attempt 2: {stderr.decode()}")
+            if returncode != 0 or not filename.exists():
+                logger.warning(f"❌ Attempt 2 (Cookies) failed (Code {returncode}, File: {filename.exists()})")
+                logger.error(f"Full stderr from Attempt 2: {err_msg}")
                 logger.warning("🧱 Both local yt-dlp attempts failed. Triggering Cobalt API fallback sequence...")
                 
                 success = await download_instagram_cobalt(url, filename)
@@ -2750,11 +3641,9 @@ async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom
                     )
                     cmd_fb = [executable, "-f", fallback_fmt, "--merge-output-format", "mp4",
                               "--extractor-args", "youtube:player_client=ios,mweb",
-                              *ffmpeg_args, "-o", str(filename), "--no-playlist", url]
-                    proc_fb = await asyncio.create_subprocess_exec(
-                        *cmd_fb, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                    )
-                    await proc_fb.communicate()
+                              *ffmpeg_args, "-o", str(filename),
+                              "--no-progress", "--quiet", "--no-playlist", url]
+                    await run_yt_dlp(cmd_fb)
                     if filename.exists():
                         new_size_mb = filename.stat().st_size / 1024 / 1024
                         logger.info(f"\U0001f4ca {fallback_h}p size: {new_size_mb:.1f}MB")
@@ -2766,23 +3655,12 @@ async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom
                 if not fitted:
                     logger.error("\U0001f6ab All step-down qualities still exceed 50MB.")
                     filename.unlink(missing_ok=True)
-                    if info_file.exists(): info_file.unlink()
                     return "TOO_LARGE"
         else:
             logger.error(f"❓ Download appeared successful but file '{filename}' is missing on disk.")
             return False
 
-        # 5. Extract caption from info.json
-        original_caption = ""
-        if info_file.exists():
-            try:
-                import json
-                with open(info_file, 'r', encoding='utf-8') as f:
-                    info = json.load(f)
-                original_caption = info.get('description', '') or info.get('title', '') or ''
-                info_file.unlink()  # Cleanup
-            except Exception as e:
-                logger.warning(f"Could not read caption: {e}")
+        # 5. Caption (description or title) was returned by run_yt_dlp
 
         # 6. Build caption with smart_split
         header = custom_caption_header if custom_caption_header else f"📥 <b>Su6i Yar</b> | @su6i_yar_bot"
@@ -2805,42 +3683,33 @@ async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom
             # 6. Send to Telegram
             logger.info(f"📤 Sending video to {chat_id}...")
             try:
-                # Open thumb if exists
-                thumb_file = open(thumb_path, "rb") if thumb_path else None
+                # A local Bot API server takes the path itself (zero copy). Otherwise
+                # PTB buffers the upload anyway, so read it without blocking the loop.
+                if bot.local_mode:
+                    video_bytes, thumb_bytes = filename, thumb_path
+                else:
+                    video_bytes = await read_file_async(filename)
+                    thumb_bytes = await read_file_async(thumb_path) if thumb_path else None
                 
                 video_msg = await bot.send_video(
                     chat_id=chat_id,
-                    video=open(filename, "rb"), # Use open() directly
+                    video=video_bytes,
+                    filename=filename.name,
                     caption=caption, # Use 'caption' instead of 'clean_cap'
                     parse_mode="HTML",
                     reply_to_message_id=reply_to_message_id,
                     duration=int(duration),
                     width=width,
                     height=height,
-                    thumbnail=thumb_file,
+                    thumbnail=thumb_bytes,
                     supports_streaming=True
                 )
                 
-                if thumb_file: thumb_file.close()
-                if thumb_path and thumb_path.exists(): thumb_path.unlink()
-                
                 # Send overflow text as reply to video (multiple parts if needed)
                 if overflow_text:
                     # For messages, max is 4096. No header needed for follow-up.
-                    # We can use smart_split again or just chunk it.
-                    remaining = overflow_text
-                    while remaining:
-                        chunk = remaining[:4000]
-                        remaining = remaining[4000:]
-                        await bot.send_message(
-                            chat_id=chat_id,
-                            text=f"📝 <b>ادامه کپشن:</b>\n\n{html.escape(chunk)}",
-                            parse_mode='HTML',
-                            reply_to_message_id=video_msg.message_id
-                        )
+                    await send_overflow_text(bot, chat_id, overflow_text, "ادامه کپشن", video_msg.message_id)
                 
-                # Cleanup
-                filename.unlink()
                 return True
             except Exception as send_e:
                 logger.error(f"Error sending video/overflow: {send_e}")
@@ -2851,6 +3720,11 @@ async def download_instagram(url, chat_id, bot, reply_to_message_id=None, custom
     except Exception as e:
         logger.error(f"DL Exception: {e}")
         return False
+    finally:
+        # Cleanup temp files on every path (success, failure, cancellation)
+        for leftover in (filename, thumb_path):
+            if leftover:
+                await asyncio.to_thread(leftover.unlink, missing_ok=True)
 
 # ==============================================================================
 # HANDLERS
@@ -2923,7 +3797,7 @@ async def cmd_birthday_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     print(f"DEBUG: Birthday CMD by {user.id}")
 
     # 3. Security Check: Only Admin executes logic
-    if user.id != SETTINGS["admin_id"]:
+    if user.id != ADMIN_ID:
         print(f"⛔ Ignore: User {user.id} is not Admin.")
         return
 
@@ -2938,7 +3812,7 @@ async def cmd_birthday_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     subcmd = args[0].lower()
-    logger.info(f"🎂 Birthday CMD: {subcmd} | User: {user.id} | Admin: {SETTINGS['admin_id']}")
+    logger.info(f"🎂 Birthday CMD: {subcmd} | User: {user.id} | Admin: {ADMIN_ID}")
     
     # --- ADD ---
     if subcmd == "add":
@@ -3062,7 +3936,6 @@ async def cmd_birthday_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         target_name = args[1]
         
         # Determine month
-        from datetime import datetime
         now = datetime.now()
         
         # If date provided
@@ -3109,6 +3982,7 @@ async def cmd_birthday_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             english_name_for_img = target_name # Fallback
             
             try:
+                from langchain_google_genai import ChatGoogleGenerativeAI
                 model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
                 prompt = (
                     f"I need a birthday wish for user '{target_name}' (born in month {month_name}).\n"
@@ -3118,9 +3992,8 @@ async def cmd_birthday_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 response = await model.invoke(prompt)
                 
                 # cleaner parsing
-                import json
-                text_resp = response.content.replace('```json', '').replace('```', '').strip()
-                data = json.loads(text_resp)
+                text_resp = strip_code_fence(response.content)
+                data = parse_json(text_resp)
                 
                 caption += data.get("wish", "تولدت مبارک!")
                 english_name_for_img = data.get("english_name", target_name)
@@ -3197,8 +4070,8 @@ async def cmd_birthday_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     # --- SCAN ---
     elif subcmd == "scan":
         logger.info(f"🔍 Scan requested by {user.id}")
-        if user.id != SETTINGS["admin_id"]:
-             logger.warning(f"⛔ Access Denied: User {user.id} != Admin {SETTINGS['admin_id']}")
+        if user.id != ADMIN_ID:
+             logger.warning(f"⛔ Access Denied: User {user.id} != Admin {ADMIN_ID}")
              # For unauthorized, we already logged and returned at start of handler, but this block is redundant now.
              # Removing logic to rely on the top-level check.
              pass
@@ -3227,11 +4100,7 @@ async def cmd_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     msg = update.message
     user_id = update.effective_user.id
     
-    dl_s = get_msg("dl_on", user_id) if SETTINGS["download"] else get_msg("dl_off", user_id)
-    fc_s = get_msg("fc_on", user_id) if SETTINGS["fact_check"] else get_msg("fc_off", user_id)
-    info = get_msg("status_fmt", user_id).format(dl=dl_s, fc=fc_s)
-    
-    # Add user quota info
+    # Status header + user quota info
     full_status = get_status_text(user_id)
     await reply_with_countdown(update, context, full_status, delay=30, parse_mode='Markdown')
 
@@ -3296,10 +4165,10 @@ async def cmd_download_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             return
 
         status_msg = await msg.reply_text(get_msg("downloading", user_id), reply_to_message_id=reply_to_id)
+        filename = thumb_path = thumb_file = None
         try:
             # A) Download
-            timestamp = int(asyncio.get_event_loop().time())
-            filename = Path(f"dl_file_{timestamp}.mp4")
+            filename = reserve_temp_path("dl_file_", ".mp4")
             
             new_file = await target_video.get_file()
             await new_file.download_to_drive(custom_path=filename)
@@ -3337,21 +4206,9 @@ async def cmd_download_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             
             # Send overflow text as reply to video
             if overflow_text:
-                remaining = overflow_text
-                while remaining:
-                    chunk = remaining[:4000]
-                    remaining = remaining[4000:]
-                    await context.bot.send_message(
-                        chat_id=msg.chat_id,
-                        text=f"📝 <b>ادامه کپشن:</b>\n\n{html.escape(chunk)}",
-                        parse_mode='HTML',
-                        reply_to_message_id=video_msg.message_id
-                    )
+                await send_overflow_text(context.bot, msg.chat_id, overflow_text, "ادامه کپشن", video_msg.message_id,
+                                         chat_type=msg.chat.type)
             
-            # Cleanup
-            if thumb_file: thumb_file.close()
-            if thumb_path and thumb_path.exists(): thumb_path.unlink()
-            if filename.exists(): filename.unlink()
             if not IS_DEV: await safe_delete(status_msg)
             
             return # Done
@@ -3361,11 +4218,16 @@ async def cmd_download_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             await reply_including_error(update, context, "خطا در پردازش ویدیو.", str(e))
             if not IS_DEV: await safe_delete(status_msg)
             return
+        finally:
+            # Cleanup on every path (a failed send used to leak the temp files)
+            if thumb_file: thumb_file.close()
+            for leftover in (filename, thumb_path):
+                if leftover:
+                    leftover.unlink(missing_ok=True)
 
     # 3. Extract URL (If no video file)
     # Generic regex for any http/https URL
-    import re
-    match = re.search(r'(https?://\S+)', target_link)
+    match = _URL_RE.search(target_link)
     if match:
         target_link = match.group(1)
     
@@ -3392,7 +4254,7 @@ async def cmd_download_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             # Video sent successfully, cleanup status
             if not IS_DEV: await safe_delete(status_msg)
             # Cleanup command msg if in group
-            if msg.chat_id < 0:
+            if is_group_chat(msg):
                 async def del_cmd(ctx):
                     try: await ctx.bot.delete_message(chat_id=msg.chat_id, message_id=msg.message_id)
                     except: pass
@@ -3409,14 +4271,18 @@ async def cmd_download_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await reply_and_delete(update, context, get_msg("err_dl", user_id), delay=10)
 
 
+def request_graceful_stop(context: ContextTypes.DEFAULT_TYPE):
+    """Ask run_polling to return; PTB then stops and shuts down the app, letting in-flight sends finish"""
+    logger.info("🛑 Graceful shutdown requested")
+    context.application.stop_running()
+
 async def cmd_stop_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id != SETTINGS["admin_id"]:
+    if user_id != ADMIN_ID:
         await update.message.reply_text(get_msg("only_admin"))
         return
     await update.message.reply_text(get_msg("bot_stop"), reply_markup=ReplyKeyboardRemove())
-    logger.info("🛑 KILLING PROCESS WITH SIGKILL (9)")
-    os.kill(os.getpid(), signal.SIGKILL)
+    request_graceful_stop(context)
 
 
 
@@ -3447,6 +4313,140 @@ async def channel_post_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.info(f"⚡ Auto-Fun Triggered for Channel Post in @{chat_username}")
         await cmd_fun_handler(update, context)
 
+# ==============================================================================
+# LOGIC: MENU BUTTON HANDLERS (used by global_message_handler dispatch)
+# Each returns True when it handled the message.
+# ==============================================================================
+
+async def _menu_status(update, context, user_id, lang):
+    msg = update.message
+    full_status = get_status_text(user_id)
+    
+    # In groups, send privately
+    if is_group_chat(msg):
+        try:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=full_status,
+                parse_mode='Markdown'
+            )
+            await reply_and_delete(update, context, get_msg("status_private_sent", user_id), delay=10)
+        except Exception:
+            # User hasn't started private chat with bot
+            await reply_and_delete(update, context, get_msg("status_private_error", user_id), delay=15)
+    else:
+        await reply_and_delete(update, context, full_status, delay=30, parse_mode='Markdown')
+    return True
+
+async def _set_lang(update, context, user_id, new_lang, confirm_text, auto_delete):
+    # Re-tapping the current language changes nothing: skip the file write
+    if USER_LANG.get(user_id) != new_lang:
+        USER_LANG[user_id] = new_lang
+        save_persistence()
+    if auto_delete:
+        await reply_and_delete(update, context, confirm_text, reply_markup=get_main_keyboard(user_id))
+    else:
+        await update.message.reply_text(confirm_text, reply_markup=get_main_keyboard(user_id))
+    logger.info(f"🌐 User {user_id} switched to {new_lang}")
+    return True
+
+async def _menu_lang_fa(update, context, user_id, lang):
+    return await _set_lang(update, context, user_id, "fa", "✅ زبان فارسی انتخاب شد.", True)
+
+async def _menu_lang_en(update, context, user_id, lang):
+    return await _set_lang(update, context, user_id, "en", "✅ English language selected.", False)
+
+async def _menu_lang_fr(update, context, user_id, lang):
+    return await _set_lang(update, context, user_id, "fr", "✅ Langue française sélectionnée.", True)
+
+async def _menu_lang_ko(update, context, user_id, lang):
+    return await _set_lang(update, context, user_id, "ko", "✅ 한국어가 선택되었습니다.", False)
+
+async def _menu_voice(update, context, user_id, lang):
+    msg = update.message
+    detail_text = get_last_analysis(user_id)
+    if not detail_text:
+        await msg.reply_text("⛔ هیچ تحلیل ذخیره‌شده‌ای موجود نیست.")
+        return True
+    status_msg = await msg.reply_text(get_msg("voice_generating", user_id))
+    try:
+        audio_buffer = await text_to_speech(detail_text, lang)
+        await msg.reply_voice(voice=audio_buffer, caption="🔊 نسخه صوتی تحلیل")
+        await safe_delete(status_msg)
+    except Exception as e:
+        logger.error(f"TTS Error: {e}")
+        await status_msg.edit_text(get_msg("voice_error", user_id))
+    return True
+
+async def _menu_help(update, context, user_id, lang):
+    # Use monospace help for all languages
+    help_mono = get_msg("help_msg_mono", user_id)
+    if help_mono:
+        await reply_with_countdown(update, context, help_mono, delay=60, parse_mode='Markdown')
+    else:
+        # Fallback to standard help if mono not available
+        help_text = get_msg("help_msg", user_id)
+        await reply_with_countdown(update, context, help_text, delay=60, parse_mode='Markdown')
+    return True
+
+async def _menu_price(update, context, user_id, lang):
+    await cmd_price_handler(update, context)
+    return True
+
+async def _menu_toggle_dl(update, context, user_id, lang):
+    SETTINGS["download"] = not SETTINGS["download"]
+    state = get_msg("dl_on", user_id) if SETTINGS["download"] else get_msg("dl_off", user_id)
+    await update.message.reply_text(get_msg("action_dl", user_id).format(state=state))
+    return True
+
+async def _menu_toggle_fc(update, context, user_id, lang):
+    SETTINGS["fact_check"] = not SETTINGS["fact_check"]
+    state = get_msg("fc_on", user_id) if SETTINGS["fact_check"] else get_msg("fc_off", user_id)
+    await update.message.reply_text(get_msg("action_fc", user_id).format(state=state))
+    return True
+
+async def _menu_stop(update, context, user_id, lang):
+    # Admin only; anyone else falls through to normal processing
+    if user_id != ADMIN_ID:
+        return False
+    logger.info("🛑 Stop Button Triggered")
+    await update.message.reply_text(get_msg("bot_stop", user_id), reply_markup=ReplyKeyboardRemove())
+    request_graceful_stop(context)
+    return True
+
+# First codepoint of a menu button -> handler ("ℹ️" is "ℹ" + variation selector)
+MENU_DISPATCH = {
+    "📊": _menu_status,
+    "🔊": _menu_voice,
+    "ℹ": _menu_help,
+    "🆘": _menu_help,
+    "📥": _menu_toggle_dl,
+    "🧠": _menu_toggle_fc,
+    "🛑": _menu_stop,
+}
+
+# Substring triggers, scanned in order only when MENU_DISPATCH missed
+MENU_SUBSTRING_DISPATCH = (
+    ("فارسی", _menu_lang_fa),
+    ("English", _menu_lang_en),
+    ("Français", _menu_lang_fr),
+    ("한국어", _menu_lang_ko),
+    ("قیمت ارز و طلا", _menu_price),
+    ("Currency & Gold", _menu_price),
+    ("Devises & Or", _menu_price),
+    ("환율 및 금 시세", _menu_price),
+    ("راستی‌آزمایی", _menu_toggle_fc),
+)
+
+# All substring triggers in one alternation: a single pass over the message
+_MENU_TRIGGER_RE = re.compile("|".join(re.escape(t) for t, _ in MENU_SUBSTRING_DISPATCH))
+_MENU_TRIGGER_PRIORITY = {t: i for i, (t, _) in enumerate(MENU_SUBSTRING_DISPATCH)}
+
+def match_menu_trigger(text):
+    """Handler of the highest-priority substring trigger found in text, else None"""
+    hits = [_MENU_TRIGGER_PRIORITY[m.group(0)] for m in _MENU_TRIGGER_RE.finditer(text)]
+    return MENU_SUBSTRING_DISPATCH[min(hits)][1] if hits else None
+
 async def global_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """MASTER HANDLER: Processes ALL text messages"""
     msg = update.message
@@ -3462,108 +4462,13 @@ async def global_message_handler(update: Update, context: ContextTypes.DEFAULT_T
 
     logger.info(f"📨 Message received: '{text}' from {user.id} ({lang})")
 
-    logger.info(f"📨 Message received: '{text}' from {user.id} ({lang})")
-
-    # --- 1. MENU COMMANDS (Check by Emoji/Start) --- 
-    
-    # Status
-    if text.startswith("📊"):
-        full_status = get_status_text(user_id)
-        
-        # In groups, send privately
-        
-        # In groups, send privately
-        if msg.chat_id < 0:  # Negative ID = group
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=full_status,
-                    parse_mode='Markdown'
-                )
-                notify = await reply_and_delete(update, context, get_msg("status_private_sent", user_id), delay=10)
-            except Exception:
-                # User hasn't started private chat with bot
-                await reply_and_delete(update, context, get_msg("status_private_error", user_id), delay=15)
-        else:
-            await reply_and_delete(update, context, full_status, delay=30, parse_mode='Markdown')
-        return
-
-    # Language Switching
-    if "فارسی" in text:
-        USER_LANG[user_id] = "fa"
-        save_persistence()
-        await reply_and_delete(update, context, "✅ زبان فارسی انتخاب شد.", reply_markup=get_main_keyboard(user_id))
-        return
-    if "English" in text:
-        USER_LANG[user_id] = "en"
-        save_persistence()
-        await msg.reply_text("✅ English language selected.", reply_markup=get_main_keyboard(user_id))
-        logger.info(f"🇺🇸 User {user_id} switched to English")
+    # --- 1. MENU COMMANDS (Dispatch by first emoji, then by substring) --- 
+    handler = MENU_DISPATCH.get(text[:1])
+    if handler and await handler(update, context, user_id, lang):
         return
-    if "Français" in text:
-        USER_LANG[user_id] = "fr"
-        save_persistence()
-        await reply_and_delete(update, context, "✅ Langue française sélectionnée.", reply_markup=get_main_keyboard(user_id))
-        return
-    if "한국어" in text:
-        USER_LANG[user_id] = "ko"
-        save_persistence()
-        await msg.reply_text("✅ 한국어가 선택되었습니다.", reply_markup=get_main_keyboard(user_id))
-        return
-    
-    # Voice Button
-    if text.startswith("🔊"):
-        detail_text = LAST_ANALYSIS_CACHE.get(user_id)
-        if not detail_text:
-            await msg.reply_text("⛔ هیچ تحلیل ذخیره‌شده‌ای موجود نیست.")
-            return
-        status_msg = await msg.reply_text(get_msg("voice_generating", user_id))
-        try:
-            audio_buffer = await text_to_speech(detail_text, lang)
-            await msg.reply_voice(voice=audio_buffer, caption="🔊 نسخه صوتی تحلیل")
-            await safe_delete(status_msg)
-        except Exception as e:
-            logger.error(f"TTS Error: {e}")
-            await status_msg.edit_text(get_msg("voice_error", user_id))
-        return
-        
-    # Help
-    if text.startswith("ℹ️") or text.startswith("🆘"):
-        # Use monospace help for all languages
-        help_mono = get_msg("help_msg_mono", user_id)
-        if help_mono:
-            await reply_with_countdown(update, context, help_mono, delay=60, parse_mode='Markdown')
-        else:
-            # Fallback to standard help if mono not available
-            help_text = get_msg("help_msg", user_id)
-            await reply_with_countdown(update, context, help_text, delay=60, parse_mode='Markdown')
-        return
-
-    # Price Check
-    if "قیمت ارز و طلا" in text or "Currency & Gold" in text or "Devises & Or" in text or "환율 및 금 시세" in text:
-        await cmd_price_handler(update, context)
-        return
-
-    # Toggle DL
-    if text.startswith("📥"):
-        SETTINGS["download"] = not SETTINGS["download"]
-        state = get_msg("dl_on", user_id) if SETTINGS["download"] else get_msg("dl_off", user_id)
-        await msg.reply_text(get_msg("action_dl", user_id).format(state=state))
-        return
-
-    # Toggle FC
-    if text.startswith("🧠") or "راستی‌آزمایی" in text:
-        SETTINGS["fact_check"] = not SETTINGS["fact_check"]
-        state = get_msg("fc_on", user_id) if SETTINGS["fact_check"] else get_msg("fc_off", user_id)
-        await msg.reply_text(get_msg("action_fc", user_id).format(state=state))
-        return
-
-    # Stop (Button)
-    if text.startswith("🛑") and user_id == SETTINGS["admin_id"]:
-        logger.info("🛑 Stop Button Triggered")
-        await msg.reply_text(get_msg("bot_stop", user_id), reply_markup=ReplyKeyboardRemove())
-        await asyncio.sleep(1)
-        os.kill(os.getpid(), signal.SIGKILL)
+    handler = match_menu_trigger(text)
+    if handler:
+        await handler(update, context, user_id, lang)
         return
 
     # --- 2. SUPPORTED VIDEO LINK CHECK (Instagram / YouTube / Aparat) ---
@@ -3582,23 +4487,28 @@ async def global_message_handler(update: Update, context: ContextTypes.DEFAULT_T
             get_msg("downloading", user_id),
             reply_to_message_id=msg.message_id
         )
-        success = await download_instagram(text, msg.chat_id, context.bot, msg.message_id,
-                                           custom_caption_header=f"📥 {platform}",
-                                           max_height=480)
-        if success == "TOO_LARGE":
-            await status_msg.edit_text(get_msg("err_too_large", user_id))
-            if not IS_DEV:
-                async def del_msg(ctx): await safe_delete(status_msg)
-                context.job_queue.run_once(del_msg, 15)
-        elif success:
-            if not IS_DEV: await safe_delete(status_msg)
-        else:
-            await status_msg.edit_text(get_msg("err_dl", user_id))
+
+        async def run_download():
+            success = await download_instagram(text, msg.chat_id, context.bot, msg.message_id,
+                                               custom_caption_header=f"📥 {platform}",
+                                               max_height=480)
+            if success == "TOO_LARGE":
+                await status_msg.edit_text(get_msg("err_too_large", user_id))
+                if not IS_DEV:
+                    async def del_msg(ctx): await safe_delete(status_msg)
+                    context.job_queue.run_once(del_msg, 15)
+            elif success:
+                if not IS_DEV: await safe_delete(status_msg)
+            else:
+                await status_msg.edit_text(get_msg("err_dl", user_id))
+
+        # Runs in this chat's queue so other chats aren't blocked behind it
+        enqueue_chat_work(msg.chat_id, run_download(), update, context)
         return
 
     # --- 3. AI ANALYSIS (Fallback) ---
-    
-    if SETTINGS["fact_check"] and len(text) >= SETTINGS["min_fc_len"]:
+    # Cheap gates first: short texts never reach the access/quota lookups
+    if SETTINGS["fact_check"] and len(text) >= MIN_FC_LEN:
         # Access Control Check
         allowed, reason = check_access(user_id, msg.chat_id)
         if not allowed:
@@ -3616,21 +4526,19 @@ async def global_message_handler(update: Update, context: ContextTypes.DEFAULT_T
             get_msg("analyzing", user_id),
             reply_to_message_id=msg.message_id
         )
-        response = await analyze_text_gemini(text, status_msg, lang, user_id)
-        
-        # Increment usage and get remaining
-        remaining = increment_daily_usage(user_id)
-        
-        await smart_reply(msg, status_msg, response, user_id, lang)
-        
-        # Show remaining requests (skip for admin)
-        if user_id != SETTINGS["admin_id"]:
-            limit = get_user_limit(user_id)
-            limit = get_user_limit(user_id)
-            await msg.reply_text(
-                get_msg("remaining_requests", user_id).format(remaining=remaining, limit=limit),
-                reply_to_message_id=status_msg.message_id
-            )
+
+        async def run_analysis():
+            response = await analyze_text_gemini(text, status_msg, lang, user_id)
+            
+            # Increment usage and get remaining
+            remaining = increment_daily_usage(user_id)
+            
+            # Remaining requests ride along in the reply itself (no extra message)
+            await smart_reply(msg, status_msg, response, user_id, lang,
+                              footer=quota_footer(user_id, remaining))
+
+        # Runs in this chat's queue so other chats aren't blocked behind it
+        enqueue_chat_work(msg.chat_id, run_analysis(), update, context)
         return
 
 # ==============================================================================
@@ -3644,7 +4552,7 @@ async def cmd_detail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     # Check Cache
-    detail_text = LAST_ANALYSIS_CACHE.get(user_id)
+    detail_text = get_last_analysis(user_id)
     
     if not detail_text:
         await msg.reply_text("⛔ هیچ تحلیل ذخیره‌شده‌ای موجود نیست. ابتدا یک متن را تحلیل کنید.")
@@ -3660,48 +4568,24 @@ async def cmd_detail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     if len(detail_text) <= max_length:
         # Fits in one message
-        try:
-            await msg.reply_text(detail_text, parse_mode='Markdown', reply_to_message_id=reply_target_id)
-        except Exception:
-            await msg.reply_text(detail_text, parse_mode=None, reply_to_message_id=reply_target_id)
+        await tg_send(msg.reply_text, markdown_to_html(detail_text), parse_mode=ParseMode.HTML,
+                      reply_to_message_id=reply_target_id)
     else:
         # ... (rest of chunking logic)
         # Need to chunk - split by paragraphs
-        paragraphs = detail_text.split('\n\n')
-        chunks = []
-        current_chunk = ""
-        
-        for para in paragraphs:
-            # If adding this paragraph exceeds limit, save current chunk and start new one
-            if len(current_chunk) + len(para) + 2 > max_length:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = para
-            else:
-                if current_chunk:
-                    current_chunk += "\n\n" + para
-                else:
-                    current_chunk = para
-        
-        # Don't forget the last chunk
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        chunks = chunk_paragraphs(detail_text, max_length)
         
-        # Send all chunks
+        # Send all chunks as HTML (always parses: no plain-text retry)
         for i, chunk in enumerate(chunks):
-            try:
-                if i == 0:
-                    await msg.reply_text(f"{chunk}\n\n━━━━━━━━━━━━━━\n📄 بخش {i+1} از {len(chunks)}", parse_mode='Markdown')
-                else:
-                    await msg.reply_text(f"📄 بخش {i+1} از {len(chunks)}\n━━━━━━━━━━━━━━\n\n{chunk}", parse_mode='Markdown')
-            except Exception:
-                if i == 0:
-                    await msg.reply_text(f"{chunk}\n\n━━━━━━━━━━━━━━\n📄 بخش {i+1} از {len(chunks)}", parse_mode=None)
-                else:
-                    await msg.reply_text(f"📊 بخش {i+1} از {len(chunks)}\n━━━━━━━━━━━━━━\n\n{chunk}", parse_mode=None, reply_to_message_id=reply_target_id)
+            chunk = markdown_to_html(chunk)
+            if i == 0:
+                text = f"{chunk}\n\n━━━━━━━━━━━━━━\n<b>📄 بخش {i+1} از {len(chunks)}</b>"
+            else:
+                text = f"<b>📄 بخش {i+1} از {len(chunks)}</b>\n━━━━━━━━━━━━━━\n\n{chunk}"
+            await tg_send(msg.reply_text, text, parse_mode=ParseMode.HTML)
         
     # Delete command in groups
-    if msg.chat_id < 0:
+    if is_group_chat(msg):
         await safe_delete(msg)
 
 
@@ -3728,6 +4612,36 @@ DATACULA_API_URL = "https://tts.datacula.com/api/tts"
 
 # Sherpa functions removed.
 
+# Semantic Emoji Mapping (Convert visual status to spoken text)
+TTS_EMOJI_MAP = {
+    "✅": "تأیید شده",
+    "❌": "رد شده",
+    "⛔": "غیرمجاز",
+    "⚠️": "هشدار",
+    "🧠": "تحلیل",
+    "💡": "نتیجه",
+    "📄": "منبع",
+    "🔍": "بررسی",
+    "📊": "آمار",
+    "📈": "روند",
+    "📉": "روند نزولی",
+    "🆔": "شناسه",
+    "👤": "کاربر",
+    "🟢": "فعال",
+    "🔴": "غیرفعال",
+}
+
+# TTS cleanup patterns, compiled once (all emoji replaced in a single pass)
+_TTS_EMOJI_RE = re.compile("|".join(re.escape(e) for e in TTS_EMOJI_MAP))
+_TTS_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+_TTS_HEADER_RE = re.compile(r'(\n|^)\s*([^\n]{1,60}?):\s*')
+_TTS_SPACES_RE = re.compile(r'[ \t]+')
+_TTS_NEWLINES_RE = re.compile(r'\n{2,}')
+_PERSIAN_CHAR_RE = re.compile(r'[\u0600-\u06FF]')
+
+# Arabic/Persian Diacritics (Harakat) 064B-0652 + basic punctuation kept for TTS
+_TTS_KEEP_CHARS = frozenset(".،?!؟,") | frozenset(chr(i) for i in range(0x064B, 0x0653))
+
 def clean_text_strict(text: str) -> str:
     """
     Strict cleaning for Persian TTS as requested:
@@ -3736,32 +4650,11 @@ def clean_text_strict(text: str) -> str:
     - Remove numbers, other emojis, and styling symbols.
     - Ensure titles/headers are on separate lines.
     """
-    # 0. Semantic Emoji Mapping (Convert visual status to spoken text)
-    emoji_map = {
-        "✅": "تأیید شده",
-        "❌": "رد شده",
-        "⛔": "غیرمجاز",
-        "⚠️": "هشدار",
-        "🧠": "تحلیل",
-        "💡": "نتیجه",
-        "📄": "منبع",
-        "🔍": "بررسی",
-        "📊": "آمار",
-        "📈": "روند",
-        "📉": "روند نزولی",
-        "🆔": "شناسه",
-        "👤": "کاربر",
-        "🟢": "فعال",
-        "🔴": "غیرفعال",
-    }
-    
-    for emoji_char, text_replacement in emoji_map.items():
-        text = text.replace(emoji_char, f" {text_replacement} ")
+    # 0. Semantic Emoji Mapping
+    text = _TTS_EMOJI_RE.sub(lambda m: f" {TTS_EMOJI_MAP[m.group(0)]} ", text)
 
-    # 0.5. Explicit Removals (User Requests)
-    
     # 1. Handle Titles/Headers (Markdown bold) -> Add period for pause
-    text = re.sub(r'\*\*(.*?)\*\*', r' . . . \1 . . . ', text)
+    text = _TTS_BOLD_RE.sub(r' . . . \1 . . . ', text)
 
     # 2. PAUSE STRATEGY (User Request):
     # Detect Headers/Titles ending in colon (:) -> Surround with explicitly punctuation pauses.
@@ -3769,62 +4662,105 @@ def clean_text_strict(text: str) -> str:
     # Pattern: Start of line, optional emoji/bullet, short text (max 60 chars), colon.
     # Replacement:  . . . Text . . . 
     # This handles keys such as "General Status", "Claim", "Audio Version", etc.
-    text = re.sub(r'(\n|^)\s*([^\n]{1,60}?):\s*', r'\1 . . . \2 . . . ', text)
+    text = _TTS_HEADER_RE.sub(r'\1 . . . \2 . . . ', text)
     
     # Replace remaining colons (inline) with dot for pause
     text = text.replace(":", " . ")
 
-    # 2.5 Allow Arabic/Persian Diacritics (Harakat) explicitly
-    # 064B-0652: Fathah, Dammah, Kasrah, etc.
-    allowed_diacritics = {chr(i) for i in range(0x064B, 0x0653)}
-
-    clean_chars = []
-    for char in text:
-        # Keep letters, spaces, newlines, basic punctuation, AND diacritics
-        if char.isalpha() or char.isspace() or char in ".،?!؟," or char in allowed_diacritics:
-            clean_chars.append(char)
-        else:
-            clean_chars.append(" ")
-            
-    text = "".join(clean_chars)
+    # 2.5 Keep letters, spaces, newlines, basic punctuation, AND diacritics
+    keep = _TTS_KEEP_CHARS
+    text = "".join(
+        char if (char.isalpha() or char.isspace() or char in keep) else " "
+        for char in text
+    )
     
     # 3. Final Polish
     # Collapse multiple spaces but PRESERVE newlines (important for the user's strategy)
-    text = re.sub(r'[ \t]+', ' ', text) 
+    text = _TTS_SPACES_RE.sub(' ', text)
     # Collapse excessive newlines to avoid long silence loops
-    text = re.sub(r'\n{2,}', '\n\n', text)
+    text = _TTS_NEWLINES_RE.sub('\n\n', text)
     
     return text.strip()
 
+async def stream_edge_tts(text: str, voice: str):
+    """Yield EdgeTTS audio bytes as they are synthesized"""
+    communicate = edge_tts.Communicate(text, voice)
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            yield chunk["data"]
+
+# Long texts are synthesized as sentence-aligned segments in parallel; MP3
+# frames concatenate cleanly, so the parts are joined in order afterwards.
+TTS_SEGMENT_CHARS = 400
+TTS_SEGMENT_CONCURRENCY = 3  # EdgeTTS sessions open at once per clip
+_TTS_SENTENCE_END_RE = re.compile(r'(?<=[.!?؟])\s+')
+
+def _tts_segments(text: str, limit: int = TTS_SEGMENT_CHARS) -> list[str]:
+    """Group sentences into segments of roughly `limit` chars"""
+    segments, current = [], ""
+    for sentence in _TTS_SENTENCE_END_RE.split(text):
+        if current and len(current) + len(sentence) + 1 > limit:
+            segments.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        segments.append(current)
+    return segments
+
+async def synthesize_edge_tts(text: str, voice: str) -> bytes:
+    """EdgeTTS audio for `text`; segments are synthesized concurrently (bounded).
+    A failing segment is retried once; if it still fails the whole call raises,
+    so callers never send audio with sentences silently missing."""
+    async def one(segment):
+        return b"".join([chunk async for chunk in stream_edge_tts(segment, voice)])
+
+    segments = _tts_segments(text)
+    if len(segments) <= 1:
+        return await one(text)
+
+    sem = asyncio.Semaphore(TTS_SEGMENT_CONCURRENCY)
+
+    async def bounded(index, segment):
+        async with sem:
+            try:
+                return await one(segment)
+            except Exception as e:
+                logger.warning(f"⚠️ EdgeTTS segment {index + 1}/{len(segments)} failed, retrying: {e}")
+            return await one(segment)
+
+    return b"".join(await asyncio.gather(*(bounded(i, seg) for i, seg in enumerate(segments))))
+
+TTS_MAX_CHARS = 2000
+
+async def prepare_tts_text(text: str) -> str:
+    """Strictly cleaned (off the event loop) and length-capped text for any TTS engine"""
+    clean_text = await asyncio.to_thread(clean_text_strict, text)
+    if not clean_text.strip():
+        clean_text = text # Fallback if empty
+    # Limit length
+    if len(clean_text) > TTS_MAX_CHARS:
+        clean_text = clean_text[:TTS_MAX_CHARS] + "..."
+    return clean_text
+
 async def text_to_speech(text: str, lang: str = "fa") -> io.BytesIO:
     """
     Convert text to speech.
     Primary: Datacula (Amir) for Persian.
     Fallback: EdgeTTS (Dilara/Farid) for Persian or others.
     """
-    import httpx
     
     # Standardize lang
     lang_key = lang[:2].lower()
     
     # Determine Logic (Is it Persian?)
-    is_persian_request = (lang_key == "fa") or (lang_key not in TTS_VOICES and re.search(r'[\u0600-\u06FF]', text))
+    is_persian_request = (lang_key == "fa") or (lang_key not in TTS_VOICES and _PERSIAN_CHAR_RE.search(text))
     
-    # Clean text STRICTLY for TTS
-    clean_text = clean_text_strict(text)
+    clean_text = await prepare_tts_text(text)
     
     # DEBUG: Log cleaning results to console
     print(f"\n--- TTS DEBUG ---\nORIGINAL: {text[:50]}...\nCLEANED:  {clean_text[:50]}...\n-----------------\n")
-    
-    if not clean_text.strip():
-        clean_text = text # Fallback if empty
-    
-    # Limit length
-    if len(clean_text) > 2000:
-        clean_text = clean_text[:2000] + "..."
 
-    audio_buffer = io.BytesIO()
-    
     # --- STRATEGY 1: DATACULA (Persian Only) ---
     if is_persian_request:
         try:
@@ -3838,9 +4774,8 @@ async def text_to_speech(text: str, lang: str = "fa") -> io.BytesIO:
                 response = await client.get(DATACULA_API_URL, params=params)
             
             if response.status_code == 200 and len(response.content) > 1000:
-                audio_buffer.write(response.content)
-                audio_buffer.seek(0)
-                return audio_buffer
+                # BytesIO(bytes) shares the buffer until written to (no copy)
+                return io.BytesIO(response.content)
             else:
                 print(f"⚠️ Datacula Failed: {response.status_code}")
                 # Fall through to EdgeTTS
@@ -3859,22 +4794,13 @@ async def text_to_speech(text: str, lang: str = "fa") -> io.BytesIO:
         voice = TTS_VOICES.get("en", "en-US-ChristopherNeural")
 
     try:
-        communicate = edge_tts.Communicate(clean_text, voice)
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_buffer.write(chunk["data"])
-        
-        audio_buffer.seek(0)
-        return audio_buffer
+        return io.BytesIO(await synthesize_edge_tts(clean_text, voice))
     except Exception as e:
         print(f"❌ EdgeTTS Failed: {e}")
         return None
 
 async def merge_bilingual_audio(target_audio: io.BytesIO, trans_audio: io.BytesIO) -> io.BytesIO:
     """Merge two audio streams with a silence gap using ffmpeg."""
-    import tempfile
-    import os
-    import subprocess
     
     try:
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -3909,8 +4835,103 @@ async def merge_bilingual_audio(target_audio: io.BytesIO, trans_audio: io.BytesI
         
     return target_audio # Fallback to just the target language audio
 
-# Language code mapping for /voice command
-LANG_ALIASES = {
+# /learn lesson prompt: a fully static prefix (so provider-side prompt caching
+# can reuse it) followed by the per-lesson INPUT block
+_EDU_PROMPT_PREFIX = (
+    "SYSTEM ROLE: You are a linguistic tutor. The INPUT block at the end gives the student's "
+    "interface language (EXPLANATION_LANG), the concept they want to learn (TARGET_TEXT) and "
+    "the language they want to learn it in (TARGET_LANG).\n\n"
+    "STRICT LANGUAGE MAPPING (FAILURE TO COMPLY IS UNACCEPTABLE):\n"
+    "1. 'word': MUST be the translation of TARGET_TEXT into TARGET_LANG.\n"
+    "2. 'sentence': MUST be a complete example sentence ONLY in TARGET_LANG.\n"
+    "3. 'meaning': MUST be a definition/explanation written ONLY in EXPLANATION_LANG.\n"
+    "4. 'translation': MUST be the translation of the 'sentence' (field #2) ONLY into EXPLANATION_LANG.\n\n"
+    "IMPORTANT: Even if TARGET_TEXT is in EXPLANATION_LANG or any other language, you MUST provide ALL explanations (meaning/translation) in EXPLANATION_LANG.\n\n"
+    "GRAMMAR RULES (CRITICAL):\n"
+    "- Use 'Triple Format' (Indefinite / Definite / Plural) ONLY for languages with articles (e.g., English, French, German).\n"
+    "- For others (e.g., Persian, Korean, Japanese), provide the word in its MOST NATURAL dictionary form. DO NOT force 3 forms if they don't exist.\n"
+    "- CRITICAL: The 'meaning' field MUST be in EXPLANATION_LANG. If providing definitions for Korean/Japanese terms, the definition MUST be in EXPLANATION_LANG (e.g., Persian).\n"
+    "- If TARGET_LANG is the same as EXPLANATION_LANG, the 'translation' field should be empty or null to avoid redundancy.\n"
+    "- Include phonetics for the TARGET_LANG word.\n\n"
+    "Return ONLY valid JSON in this structure:\n"
+    "{\n"
+    "  \"valid\": true/false,\n"
+    "  \"lang\": \"detected language of TARGET_TEXT\",\n"
+    "  \"dict\": \"source dictionary\",\n"
+    "  \"is_correction\": true/false,\n"
+    "  \"suggestion\": \"corrected TARGET_TEXT if misspelled\",\n"
+    "  \"slides\": [\n"
+    "    {\n"
+    "      \"word\": \"[TARGET_LANG terms]\",\n"
+    "      \"phonetic\": \"...\",\n"
+    "      \"meaning\": \"[Explanations ONLY in EXPLANATION_LANG]\",\n"
+    "      \"sentence\": \"[TARGET_LANG sentence]\",\n"
+    "      \"translation\": \"[Translation ONLY in EXPLANATION_LANG]\",\n"
+    "      \"prompt\": \"A highly detailed English visual description for an AI image generator. IMPORTANT: This description MUST be based on the EXACT context and scene described in the 'sentence' and 'meaning' fields. DO NOT just describe the word. Create a vivid, high-quality cinematic scene representing the concept.\",\n"
+    "      \"keywords\": \"3-4 simple English keywords representing the scene for image search\"\n"
+    "    },\n"
+    "    ... (exactly 3 variant objects)\n"
+    "  ]\n"
+    "}\n\n"
+    "INPUT:\n"
+)
+
+def build_educational_prompt(target_text: str, target_lang: str, explanation_lang: str) -> str:
+    """Static lesson rules + this lesson's variables as a trailing JSON block"""
+    return _EDU_PROMPT_PREFIX + json.dumps({
+        "TARGET_TEXT": target_text,
+        "TARGET_LANG": target_lang,
+        "EXPLANATION_LANG": explanation_lang,
+    }, ensure_ascii=False)
+
+_EXPLANATION_LANGS = {"fa": "Persian", "en": "English", "fr": "French"}
+
+# Generated /learn lessons: key -> (created_ts, variations, seed_base, photo file_ids)
+LEARN_RESULT_CACHE = LRUDict(maxsize=2000)
+LEARN_RESULT_TTL_SECONDS = 900
+# Lessons being generated right now: key -> Future resolved when it is done
+LEARN_INFLIGHT: dict[tuple, asyncio.Future] = {}
+
+def _release_learn_inflight(key, future):
+    """Wake requests waiting on an in-flight lesson (idempotent)"""
+    if future is None:
+        return
+    if LEARN_INFLIGHT.get(key) is future:
+        del LEARN_INFLIGHT[key]
+    if not future.done():
+        future.set_result(None)
+
+# Merged /learn slide audio, keyed by its texts and languages, so repeated
+# lessons (or concurrent users learning the same word) reuse one TTS+ffmpeg run.
+LEARN_AUDIO_CACHE = LRUDict(maxsize=1000)  # key -> (created_ts, bytes)
+LEARN_AUDIO_TTL_SECONDS = 1800
+LEARN_AUDIO_LOCKS: dict[tuple, asyncio.Lock] = {}
+
+async def learn_slide_audio(target_tts: str, target_lang: str, translation: str, user_lang: str) -> Optional[io.BytesIO]:
+    """Bilingual slide audio (target sentence + translation), cached for LEARN_AUDIO_TTL_SECONDS"""
+    key = (target_tts, target_lang, translation, user_lang)
+    lock = LEARN_AUDIO_LOCKS.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            cached = LEARN_AUDIO_CACHE.get(key)
+            if cached and time.time() - cached[0] < LEARN_AUDIO_TTL_SECONDS:
+                return io.BytesIO(cached[1])
+
+            target_audio_buf, trans_audio_buf = await asyncio.gather(
+                text_to_speech(target_tts, target_lang),
+                text_to_speech(translation, user_lang),
+            )
+            final_audio_buf = await merge_bilingual_audio(target_audio_buf, trans_audio_buf)
+            if final_audio_buf:
+                LEARN_AUDIO_CACHE[key] = (time.time(), final_audio_buf.getvalue())
+                final_audio_buf.seek(0)
+            return final_audio_buf
+    finally:
+        if not lock.locked() and LEARN_AUDIO_LOCKS.get(key) is lock:
+            del LEARN_AUDIO_LOCKS[key]
+
+# Language code mapping for /voice and /learn (read-only)
+LANG_ALIASES = MappingProxyType({
     "fa": "fa", "farsi": "fa", "persian": "fa", "فارسی": "fa",
     "en": "en", "english": "en", "انگلیسی": "en",
     "fr": "fr", "french": "fr", "français": "fr", "فرانسوی": "fr",
@@ -3925,7 +4946,13 @@ LANG_ALIASES = {
     "tr": "tr", "turkish": "tr", "ترکی": "tr",
     "pt": "pt", "portuguese": "pt", "پرتغالی": "pt",
     "hi": "hi", "hindi": "hi", "هندی": "hi"
-}
+})
+
+def _parse_lang_arg(args, default=None):
+    """Split command args into (language, text) when the first arg is a language alias"""
+    if args and (first := args[0].lower()) in LANG_ALIASES:
+        return LANG_ALIASES[first], " ".join(args[1:])
+    return default, " ".join(args or ())
 
 LANG_NAMES = {
     "fa": "فارسی", "en": "انگلیسی", "fr": "فرانسوی", "ko": "کره‌ای",
@@ -3941,23 +4968,33 @@ LANG_FLAGS = {
 async def translate_text(text: str, target_lang: str) -> str:
     """Translate text to target language using Gemini"""
     lang_name = LANG_NAMES.get(target_lang, "English")
+    key = _ai_cache_key("translate", text, target_lang)
+    cached = AI_RESULT_CACHE.get(key)
+    if cached is not None:
+        return cached
     
     try:
         chain = get_smart_chain(grounding=False)
         prompt = f"Translate the following text to {lang_name}. Only output the translation, no explanations:\n\n{text}"
         response = await chain.ainvoke([HumanMessage(content=prompt)])
-        return extract_text(response)
+        translated = AI_RESULT_CACHE[key] = extract_text(response)
+        return translated
     except Exception as e:
         logger.error(f"Translation error: {e}")
         return text  # Return original if translation fails
 
 async def generate_visual_prompt(text: str) -> str:
     """Generate a short English visual prompt for an image representing the text"""
+    key = _ai_cache_key("visual", text)
+    cached = AI_RESULT_CACHE.get(key)
+    if cached is not None:
+        return cached
     try:
         chain = get_smart_chain(grounding=False)
         prompt = f"Generate a short, descriptive English visual prompt (single sentence, no style words) representing the core meaning of this text: '{text}'"
         response = await chain.ainvoke([HumanMessage(content=prompt)])
-        return extract_text(response).replace('"', '').replace("'", "")
+        visual = AI_RESULT_CACHE[key] = extract_text(response).replace('"', '').replace("'", "")
+        return visual
     except Exception as e:
         logger.error(f"Visual prompt generation error: {e}")
         return "abstract conceptual representation"  # Safe default
@@ -3976,12 +5013,8 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_lang = USER_LANG.get(user_id, "fa")
     
     # Check for language argument
-    explicit_target = None
-    if context.args:
-        lang_arg = context.args[0].lower()
-        if lang_arg in LANG_ALIASES:
-            explicit_target = LANG_ALIASES[lang_arg]
-        # If not a lang alias, we assume it's direct text input later
+    # If the first arg is not a lang alias, it's direct text input
+    explicit_target, arg_text = _parse_lang_arg(context.args)
     
     # Priority 1: Check if replied to a message
     target_text = ""
@@ -3991,16 +5024,12 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_target_id = msg.reply_to_message.message_id
     
     # Priority 2: Check for direct text input
-    if not target_text and context.args:
-        if context.args[0].lower() in LANG_ALIASES:
-            if len(context.args) > 1:
-                target_text = " ".join(context.args[1:])
-        else:
-            target_text = " ".join(context.args)
+    if not target_text:
+        target_text = arg_text
     
     # Priority 3: Check cache
     if not target_text:
-        target_text = LAST_ANALYSIS_CACHE.get(user_id, "")
+        target_text = get_last_analysis(user_id, "")
         # If from cache, we might not have a good reply target, use command
         reply_target_id = msg.message_id 
     
@@ -4009,34 +5038,30 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Delete command in groups
-    if msg.chat_id < 0:
+    if is_group_chat(msg):
         await safe_delete(msg)
 
-    # Decide target language and translation need
-    # Decide target language and translation need
-    if explicit_target:
-        # User explicitly asked for a specific language -> Translate if needed
-        target_lang = explicit_target
-        # We assume the source text is usually in the user's interface language for translation purposes,
-        # but the translation logic itself handles any source.
-        # Actually, let's detect source to be sure if translation is needed.
-        source_lang = await detect_language(target_text)
-        need_translation = target_lang != source_lang
-    else:
-        # No language specified -> Use the text's natural language (no translation)
-        target_lang = await detect_language(target_text)
-        need_translation = False
+    # Decide target language and translation need: the text's own language
+    # unless one was given; translate only when they differ (a cached
+    # analysis already in the requested language is read as-is)
+    source_lang = await detect_language(target_text[:500])
+    target_lang = explicit_target or source_lang
+    need_translation = target_lang != source_lang
     
+    status_msg = None
     try:
         # 1. Translate if needed
         if need_translation:
             status_msg = await context.bot.send_message(
                 chat_id=msg.chat_id,
-                text=get_msg("voice_translating", user_id).format(lang=LANG_NAMES.get(target_lang, target_lang)),
+                text=format_msg("voice_translating", user_id, lang=LANG_NAMES.get(target_lang, target_lang)),
                 reply_to_message_id=reply_target_id
             )
             translated_text = await translate_text(target_text, target_lang)
-            await status_msg.edit_text(get_msg("voice_generating", user_id))
+            # The status edit's round-trip overlaps speech synthesis below
+            STATUS_EDIT_TASKS[(status_msg.chat_id, status_msg.message_id)] = asyncio.create_task(
+                _edit_status_quietly(status_msg, get_msg("voice_generating", user_id))
+            )
             target_text = translated_text
             voice_reply_to = reply_target_id
         else:
@@ -4046,6 +5071,13 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if target_lang == "fa":
             await context.bot.send_message(chat_id=msg.chat_id, text="🧪 <b>تست مقایسه موتورهای صوتی (۲ مدل)</b>", parse_mode="HTML", reply_to_message_id=voice_reply_to)
             
+            # EdgeTTS (Farid) synthesizes while Datacula runs (same cleaning and
+            # length cap as text_to_speech)
+            async def edge_comparison():
+                return await synthesize_edge_tts(await prepare_tts_text(target_text), "fa-IR-FaridNeural")
+
+            edge_task = asyncio.create_task(edge_comparison())
+
             # 1. Datacula (Amir)
             try:
                 audio_amir = await text_to_speech(target_text, "fa") # Default uses Datacula logic
@@ -4062,13 +5094,7 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # 3. EdgeTTS (Farid) - Force Fallback Logic
             try:
                 # Manually invoke EdgeTTS for comparison
-                audio_edge = io.BytesIO()
-                communicate = edge_tts.Communicate(clean_text_strict(target_text), "fa-IR-FaridNeural")
-                async for chunk in communicate.stream():
-                    if chunk["type"] == "audio":
-                        audio_edge.write(chunk["data"])
-                audio_edge.seek(0)
-                
+                audio_edge = io.BytesIO(await edge_task)
 
                 caption_edge = "🗣️ <b>مدل ۲: EdgeTTS (فرید)</b> - مایکروسافت"
                 await context.bot.send_voice(chat_id=msg.chat_id, voice=audio_edge, caption=caption_edge, parse_mode='HTML')
@@ -4078,8 +5104,8 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return # Exit after sending comparison
 
         # --- STANDARD SINGLE VOICE (NON-PERSIAN) ---
-        # 2. Convert to speech
-        audio_buffer = await text_to_speech(target_text, target_lang)
+        # 2. Convert to speech (caption is built while it runs)
+        tts_task = asyncio.create_task(text_to_speech(target_text, target_lang))
         
         # 3. Build caption with smart_split
         lang_name = LANG_NAMES.get(target_lang, target_lang)
@@ -4091,6 +5117,7 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             overflow_title = "ادامه متن"
             
         caption, overflow_text = smart_split(target_text, header=header, max_len=1024)
+        audio_buffer = await tts_task
         
         # 4. Send Voice
         voice_msg = await context.bot.send_voice(
@@ -4104,28 +5131,27 @@ async def cmd_voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # 5. Send overflow parts
         if overflow_text:
-            remaining = overflow_text
-            while remaining:
-                chunk = remaining[:4000]
-                remaining = remaining[4000:]
-                await context.bot.send_message(
-                    chat_id=msg.chat_id,
-                    text=f"📝 <b>{overflow_title}:</b>\n\n{html.escape(chunk)}",
-                    parse_mode='HTML',
-                    reply_to_message_id=voice_msg.message_id
-                )
+            await send_overflow_text(context.bot, msg.chat_id, overflow_text, overflow_title, voice_msg.message_id,
+                                     chat_type=msg.chat.type)
         
-        if 'status_msg' in locals():
+        if status_msg is not None:
+            await _await_status_edit(status_msg)
             if not IS_DEV: await safe_delete(status_msg)
             
     except Exception as e:
         logger.error(f"Voice Error: {e}")
         await report_error_to_admin(context, user_id, "/voice", str(e))
         error_msg = get_msg("err_ai", user_id) if 'user_id' in locals() else "خطایی رخ داد."
-        if 'status_msg' in locals():
+        if status_msg is not None:
+            await _await_status_edit(status_msg)
             if not IS_DEV: await safe_delete(status_msg)
         
         await reply_and_delete(update, context, error_msg, delay=10)
+    finally:
+        # Every exit (incl. the Persian comparison's early return) drops the
+        # pending status edit from STATUS_EDIT_TASKS
+        if status_msg is not None:
+            await _await_status_edit(status_msg)
 
 
 async def cmd_fun_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -4134,7 +5160,7 @@ async def cmd_fun_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
     
     # Try global SETTINGS first, then Env
-    admin_id = int(SETTINGS.get("admin_id", 0))
+    admin_id = ADMIN_ID
     if admin_id == 0:
         admin_id = int(os.getenv("ADMIN_ID") or 0)
     
@@ -4236,8 +5262,8 @@ async def cmd_fun_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # Download
             new_file = await target_file.get_file()
-            file_name = f"fun_{target_file.file_id}.mp4"
-            file_name_path = Path(file_name)
+            # Unique per call: the same file posted twice no longer collides
+            file_name_path = reserve_temp_path("fun_", ".mp4")
             await new_file.download_to_drive(file_name_path)
             
             # Smart Compression
@@ -4270,11 +5296,10 @@ async def cmd_fun_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     supports_streaming=True
                 )
                 if thumb_file: thumb_file.close()
-                if thumb_path and thumb_path.exists(): thumb_path.unlink()
+                if thumb_path: thumb_path.unlink(missing_ok=True)
             
             # Cleanup File
-            if os.path.exists(file_name):
-                os.remove(file_name)
+            file_name_path.unlink(missing_ok=True)
                 
             # SUCCESS
             if status_msg:
@@ -4317,7 +5342,7 @@ def extract_link_from_text(entities, text_content):
                 return text_content[entity.offset:entity.offset + entity.length]
     
     # Fallback: Regex Search
-    found = re.search(r'(https?://\S+)', text_content)
+    found = _URL_RE.search(text_content)
     if found:
         return found.group(1)
     return None
@@ -4325,8 +5350,6 @@ def extract_link_from_text(entities, text_content):
 
 async def check_birthdays_job(context: ContextTypes.DEFAULT_TYPE):
     """Daily job to check birthdays (Jalali & Gregorian)"""
-    from datetime import datetime
-    import jdatetime
     
     now = datetime.now()
     j_now = jdatetime.date.fromgregorian(date=now.date())
@@ -4371,6 +5394,7 @@ async def check_birthdays_job(context: ContextTypes.DEFAULT_TYPE):
 
                 # Gemini Generation
                 try:
+                    from langchain_google_genai import ChatGoogleGenerativeAI
                     model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
                     prompt = (
                         f"I need a birthday wish for user '{target_name}' (born in month {month_name}).\n"
@@ -4378,9 +5402,8 @@ async def check_birthdays_job(context: ContextTypes.DEFAULT_TYPE):
                         f"Respond with valid JSON only: {{ \"wish\": \"Persian wish with emojis + fun fact\", \"english_name\": \"Transliterated name\" }}"
                     )
                     response = await model.invoke(prompt)
-                    import json
-                    text_resp = response.content.replace('```json', '').replace('```', '').strip()
-                    jdata = json.loads(text_resp)
+                    text_resp = strip_code_fence(response.content)
+                    jdata = parse_json(text_resp)
                     caption += jdata.get("wish", "تولدت مبارک!")
                     english_name_for_img = jdata.get("english_name", target_name)
                 except Exception as e:
@@ -4472,6 +5495,12 @@ def main():
     
     # DIAGNOSTIC: Check connection before polling
     async def post_init(application):
+        # I/O-sized pool for asyncio.to_thread (yt-dlp, file reads, ffmpeg waits)
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=IO_EXECUTOR_WORKERS, thread_name_prefix="su6i-io")
+        )
+        # Purge expired AI answers now and then every AI_ANSWER_PURGE_INTERVAL
+        application.job_queue.run_repeating(purge_ai_answers_job, interval=AI_ANSWER_PURGE_INTERVAL, first=0)
         bot = application.bot
         print(f"⏳ Diagnostics: Checking Check connection to Telegram API...")
         try:
@@ -4484,6 +5513,12 @@ def main():
         except Exception as e:
             print(f"\n❌❌❌ CONNECTION ERROR ❌❌❌\nCould not connect to Telegram: {e}\n⚠️ Please check your VPN/Proxy settings or TELEGRAM_BOT_TOKEN.\n")
 
+    async def post_shutdown(application):
+        await flush_persistence()
+        for client in (IMAGE_HTTP_CLIENT, DEEPSEEK_HTTP_CLIENT):
+            if client is not None:
+                await client.aclose()
+
     from telegram.ext import JobQueue
     app = (
         ApplicationBuilder()
@@ -4491,6 +5526,7 @@ def main():
         .concurrent_updates(True)
         .job_queue(JobQueue())  # Enable JobQueue for countdown timers
         .post_init(post_init)   # Register diagnostic hook
+        .post_shutdown(post_shutdown)
         .build()
     )
     
@@ -4544,8 +5580,7 @@ def main():
     print("✅ Bot is Polling...")
     app.run_polling(
         allowed_updates=["message", "callback_query", "channel_post", "edited_channel_post"],  # Only listen to needed updates
-        drop_pending_updates=False,  # DEBUG: Don't drop updates
-        close_loop=False  # Allow graceful shutdown
+        drop_pending_updates=False  # DEBUG: Don't drop updates
     )
 
 if __name__ == "__main__":